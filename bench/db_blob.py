@@ -0,0 +1,52 @@
+import os
+
+from db_common import parse_args, Results, cleanup, DBFILE, redis_backends, get_redis_client
+
+from hexlib.db import PersistentState
+
+SIZES = (64, 1024, 16384, 262144)
+
+
+def run(results, backend, factory, n):
+    for size in SIZES:
+        state = factory()
+        table = state["blob"]
+        value = {"body": os.urandom(size)}
+        count = max(n * 1024 // max(size, 1024), 10)
+
+        def set_items():
+            for i in range(count):
+                table[i] = value
+
+        def get_items():
+            for i in range(count):
+                _ = table[i]
+
+        results.measure(backend, "set", count, set_items, size=size)
+        results.measure(backend, "get", count, get_items, size=size)
+
+        for result in results.results[-2:]:
+            result["mb_per_sec"] = result["ops_per_sec"] * size / 1048576
+
+        if hasattr(state, "dbfile") and os.path.exists(state.dbfile):
+            results.results[-1]["db_bytes"] = os.path.getsize(state.dbfile)
+
+        del state["blob"]
+        cleanup()
+
+
+if __name__ == '__main__':
+    args = parse_args("Blob sizes", n=2000)
+    results = Results("db_blob", args)
+    rdb, redis_name = get_redis_client(args.redis)
+
+    backends = {
+        "sqlite-fast": lambda: PersistentState(DBFILE, profile="fast"),
+        "sqlite-fast-base64": lambda: PersistentState(DBFILE, profile="fast", base64_blobs=True),
+        **redis_backends(rdb, redis_name),
+    }
+    for name, factory in backends.items():
+        cleanup()
+        run(results, name, factory, args.n)
+
+    results.dump()
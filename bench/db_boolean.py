@@ -0,0 +1,48 @@
+from redis.exceptions import ResponseError
+
+from db_common import parse_args, Results, get_redis_client
+
+from hexlib.db import VolatileBooleanState
+
+BACKENDS = ("set", "bitmap", "bloom")
+
+
+def memory_usage(rdb, pattern):
+    """Bytes used by all keys matching pattern (None if MEMORY USAGE is not supported, ex. fakeredis)"""
+    try:
+        return sum(rdb.memory_usage(key, samples=0) or 0 for key in rdb.scan_iter(pattern))
+    except ResponseError:
+        return None
+
+
+def run(results, rdb, redis_name, backend, n):
+    state = VolatileBooleanState(prefix="hexlib_bench_", redis_db=rdb, backend=backend, bloom_capacity=n)
+    table = state["seen"]
+    del state["seen"]
+
+    name = "%s-%s" % (redis_name, backend)
+    result = results.measure(name, "set_many", n, lambda: table.set_many(range(n)))
+    result["memory_bytes"] = memory_usage(rdb, "hexlib_bench_seen*")
+
+    results.measure(name, "get_many-hit", n, lambda: table.get_many(range(n)))
+    results.measure(name, "get_many-miss", n, lambda: table.get_many(range(n, 2 * n)))
+    results.measure(name, "getitem", n // 10, lambda: [table[i] for i in range(n // 10)])
+
+    if backend == "bloom":
+        found = []
+        result = results.measure(name, "false_positives", n, lambda: found.extend(table.get_many(range(2 * n, 3 * n))))
+        result["false_positive_rate"] = sum(found) / n
+
+    del state["seen"]
+
+
+if __name__ == '__main__':
+    args = parse_args("VolatileBooleanState backends (set, bitmap, bloom): throughput and memory", n=100000)
+    results = Results("db_boolean", args)
+
+    rdb, redis_name = get_redis_client(args.redis)
+    if rdb is not None:
+        for backend in BACKENDS:
+            run(results, rdb, redis_name, backend, args.n)
+
+    results.dump()
@@ -0,0 +1,111 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+from glob import glob
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from hexlib.db import PersistentState, VolatileState
+
+DBFILE = "bench_state.db"
+
+
+def parse_args(description, **defaults):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--n", type=int, default=defaults.get("n", 10000), help="Operations per scenario")
+    parser.add_argument("--redis", choices=["auto", "local", "fake", "none"], default="auto",
+                        help="Redis backend for VolatileState scenarios: local redis-server (REDIS_HOST/REDIS_PORT), "
+                             "fakeredis, or auto (local if reachable, else fakeredis)")
+    parser.add_argument("--output", default=None, help="Write JSON results to this file instead of stdout")
+    return parser.parse_args()
+
+
+def get_redis_client(mode):
+    if mode == "none":
+        return None, None
+
+    if mode in ("auto", "local"):
+        from hexlib.env import get_redis
+        rdb = get_redis()
+        try:
+            rdb.ping()
+            return rdb, "redis"
+        except Exception:
+            if mode == "local":
+                raise
+
+    try:
+        import fakeredis
+    except ImportError:
+        return None, None
+    return fakeredis.FakeRedis(), "fakeredis"
+
+
+def cleanup():
+    for file in glob(DBFILE + "*") + glob(DBFILE.replace(".db", ".*.db*")):
+        os.remove(file)
+
+
+def sqlite_backends():
+    """name -> PersistentState factory"""
+    return {
+        "sqlite": lambda: PersistentState(DBFILE),
+        "sqlite-fast": lambda: PersistentState(DBFILE, profile="fast"),
+        "sqlite-fast-cached": lambda: PersistentState(DBFILE, profile="fast", cache_size=100000),
+    }
+
+
+def redis_backends(rdb, name):
+    if rdb is None:
+        return {}
+    return {
+        name: lambda: VolatileState(prefix="hexlib_bench", redis_db=rdb),
+    }
+
+
+class Results:
+    def __init__(self, benchmark, args):
+        self._benchmark = benchmark
+        self._args = args
+        self.results = []
+
+    def measure(self, backend, scenario, ops, func, **extra):
+        """Time func(). ops can be a function, called after func() to get the number of operations"""
+        start = perf_counter()
+        func()
+        elapsed = perf_counter() - start
+
+        if callable(ops):
+            ops = ops()
+
+        result = {
+            "backend": backend,
+            "scenario": scenario,
+            "ops": ops,
+            "seconds": elapsed,
+            "ops_per_sec": ops / elapsed if elapsed else None,
+            **extra
+        }
+        self.results.append(result)
+        print("%s/%s%s: %d ops/s" % (
+            backend, scenario, "".join(" %s=%s" % kv for kv in extra.items()), result["ops_per_sec"] or 0
+        ), file=sys.stderr)
+        return result
+
+    def dump(self):
+        doc = {
+            "benchmark": self._benchmark,
+            "n": self._args.n,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "results": self.results,
+        }
+        if self._args.output:
+            with open(self._args.output, "w") as f:
+                json.dump(doc, f, indent=2)
+        else:
+            print(json.dumps(doc, indent=2))
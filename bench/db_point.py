@@ -0,0 +1,42 @@
+from db_common import parse_args, Results, cleanup, sqlite_backends, redis_backends, get_redis_client
+
+
+def run(results, backend, factory, n):
+    state = factory()
+    table = state["point"]
+    value = {"a": 1, "b": "hello world", "c": 3.5}
+
+    def set_items():
+        for i in range(n):
+            table[i] = value
+
+    def get_items():
+        for i in range(n):
+            _ = table[i]
+
+    def get_missing():
+        for i in range(n, n * 2):
+            _ = table[i]
+
+    results.measure(backend, "set", n, set_items)
+    results.measure(backend, "get", n, get_items)
+    results.measure(backend, "get-again", n, get_items)
+    results.measure(backend, "get-missing", n, get_missing)
+
+    if hasattr(table, "set_many"):
+        results.measure(backend, "set_many", n, lambda: table.set_many((i, value) for i in range(n)))
+
+    del state["point"]
+
+
+if __name__ == '__main__':
+    args = parse_args("Point get/set")
+    results = Results("db_point", args)
+    rdb, redis_name = get_redis_client(args.redis)
+
+    for name, factory in {**sqlite_backends(), **redis_backends(rdb, redis_name)}.items():
+        cleanup()
+        run(results, name, factory, args.n)
+    cleanup()
+
+    results.dump()
@@ -0,0 +1,74 @@
+from multiprocessing import Process, Value
+from time import time
+
+from db_common import parse_args, Results, cleanup, DBFILE
+
+from hexlib.db import PersistentState
+
+DURATION = 5
+WRITERS = 4
+READERS = 4
+
+
+def _writer(profile, i, counter, stop_at, keys):
+    s = PersistentState(DBFILE, profile=profile)
+    table = s["bench"]
+    cnt = 0
+    while time() < stop_at:
+        table[(cnt * WRITERS + i) % keys] = {"a": cnt, "b": "hello world"}
+        cnt += 1
+    with counter.get_lock():
+        counter.value += cnt
+
+
+def _reader(profile, i, counter, stop_at, keys):
+    s = PersistentState(DBFILE, profile=profile)
+    table = s["bench"]
+    cnt = 0
+    while time() < stop_at:
+        _ = table[(cnt * READERS + i) % keys]
+        cnt += 1
+    with counter.get_lock():
+        counter.value += cnt
+
+
+def run(results, writer_profile, reader_profile, keys):
+    cleanup()
+
+    s = PersistentState(DBFILE, profile=writer_profile)
+    s["bench"].set_many((i, {"a": i, "b": "hello world"}) for i in range(keys))
+    s.close()
+
+    writes = Value("l", 0)
+    reads = Value("l", 0)
+
+    def concurrent():
+        stop_at = time() + DURATION
+        processes = [Process(target=_writer, args=(writer_profile, i, writes, stop_at, keys)) for i in
+                     range(WRITERS)] + \
+                    [Process(target=_reader, args=(reader_profile, i, reads, stop_at, keys)) for i in range(READERS)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+
+    backend = "sqlite-%s/%s" % (writer_profile or "default", reader_profile or "default")
+    result = results.measure(backend, "concurrent", lambda: writes.value + reads.value, concurrent,
+                             writers=WRITERS, readers=READERS)
+    result["writes_per_sec"] = writes.value / result["seconds"]
+    result["reads_per_sec"] = reads.value / result["seconds"]
+
+    cleanup()
+
+
+if __name__ == '__main__':
+    args = parse_args("Concurrent reader/writer processes for each SQLite profile")
+    results = Results("db_profiles", args)
+
+    # default: ~1500 writes/s, ~6500 reads/s
+    run(results, None, None, args.n)
+    run(results, "safe", "safe", args.n)
+    run(results, "fast", "fast", args.n)
+    run(results, "fast", "readonly-mmap", args.n)
+
+    results.dump()
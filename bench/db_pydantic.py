@@ -0,0 +1,59 @@
+from datetime import datetime
+from enum import Enum
+from typing import List
+
+from pydantic import BaseModel
+
+from db_common import parse_args, Results, cleanup, DBFILE
+
+from hexlib.db import PersistentState
+
+
+class Status(Enum):
+    yes = "yes"
+    no = "no"
+
+
+class Point(BaseModel):
+    x: int
+    y: int
+
+
+class Polygon(BaseModel):
+    points: List[Point] = []
+    created_date: datetime
+    status: Status = Status.yes
+
+
+def run(results, backend, state, n):
+    table = state["pydantic"]
+    value = Polygon(created_date=datetime(2000, 1, 1), points=[Point(x=i, y=i) for i in range(10)])
+
+    def set_items():
+        for i in range(n):
+            table[i] = value
+
+    def get_items():
+        for i in range(n):
+            _ = table[i]
+
+    results.measure(backend, "set", n, set_items)
+    results.measure(backend, "set_many", n, lambda: table.set_many((i, value) for i in range(n)))
+    results.measure(backend, "get", n, get_items)
+    results.measure(backend, "iter", n, lambda: sum(1 for _ in table))
+
+
+if __name__ == '__main__':
+    args = parse_args("Pydantic round-trips", n=5000)
+    results = Results("db_pydantic", args)
+
+    for name, kwargs in (
+            ("sqlite-fast", {}),
+            ("sqlite-fast-trusted", {"trusted_pydantic": True}),
+    ):
+        cleanup()
+        with PersistentState(DBFILE, profile="fast", **kwargs) as s:
+            run(results, name, s, args.n)
+    cleanup()
+
+    results.dump()
@@ -0,0 +1,45 @@
+from db_common import parse_args, Results, cleanup, sqlite_backends, redis_backends, get_redis_client
+
+
+def run_redis(results, backend, factory, n):
+    state = factory()
+    table = state["scan"]
+    table.set_many((i, {"a": i, "b": "hello world", "c": i / 3, "d": b'x' * 512}) for i in range(n))
+
+    results.measure(backend, "iter", n, lambda: sum(1 for _ in table))
+    results.measure(backend, "iter-id-only", n, lambda: sum(1 for _ in table.keys()))
+
+    del state["scan"]
+
+
+def run(results, backend, factory, n):
+    state = factory()
+    table = state["scan"]
+    rows = ((i, {"a": i, "b": "hello world", "c": i / 3, "d": b'x' * 512}) for i in range(n))
+
+    table.set_many(rows)
+
+    results.measure(backend, "iter", n, lambda: sum(1 for _ in table))
+    results.measure(backend, "iter-batched", n, lambda: sum(1 for _ in table.iter(batch_size=1000)))
+    results.measure(backend, "iter-id-only", n, lambda: sum(1 for _ in table.keys()))
+    results.measure(backend, "sql", n // 2, lambda: sum(1 for _ in table.sql("WHERE a % 2 = 0")))
+    results.measure(backend, "to_columns", n, lambda: table.to_columns(["a", "c"]))
+
+    del state["scan"]
+
+
+if __name__ == '__main__':
+    args = parse_args("Full table scans")
+    results = Results("db_scan", args)
+
+    rdb, redis_name = get_redis_client(args.redis)
+
+    for name, factory in sqlite_backends().items():
+        cleanup()
+        run(results, name, factory, args.n)
+    cleanup()
+
+    for name, factory in redis_backends(rdb, redis_name).items():
+        run_redis(results, name, factory, args.n)
+
+    results.dump()
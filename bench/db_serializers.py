@@ -0,0 +1,49 @@
+from functools import partial
+
+import umsgpack
+
+from db_common import parse_args, Results
+
+from hexlib.serializers import SERIALIZERS, allowed_ids, loads
+
+PAYLOADS = {
+    "small": {"_id": 123456, "url": "https://example.com/a/b/c", "status": 200, "ts": 1700000000.5},
+    "document": {
+        "_id": "abcdef0123456789",
+        "title": "hello world " * 4,
+        "text": "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 40,
+        "tags": ["a", "b", "c", "d"],
+        "meta": {"score": 0.75, "lang": "en", "views": 1234, "links": ["https://example.com/%d" % i for i in range(20)]},
+    },
+    "large": {"_id": 1, "items": [{"id": i, "name": "item %d" % i, "value": i / 7} for i in range(2000)]},
+}
+
+
+def run(results, name, dumps, decode, payload_name, payload, n):
+    data = dumps(payload)
+
+    def encode_all():
+        for _ in range(n):
+            dumps(payload)
+
+    def decode_all():
+        for _ in range(n):
+            decode(data)
+
+    results.measure(name, "encode-%s" % payload_name, n, encode_all, size=len(data))
+    results.measure(name, "decode-%s" % payload_name, n, decode_all, size=len(data))
+
+
+if __name__ == '__main__':
+    args = parse_args("Serializer encode/decode throughput and size (hexlib.serializers)", n=2000)
+    results = Results("db_serializers", args)
+
+    for payload_name, payload in PAYLOADS.items():
+        # VolatileState default (serializer=None)
+        run(results, "untagged-umsgpack", umsgpack.dumps, umsgpack.loads, payload_name, payload, args.n)
+
+        for name, serializer in SERIALIZERS.items():
+            decode = partial(loads, allowed=allowed_ids(serializer))
+            run(results, name, serializer.dumps, decode, payload_name, payload, args.n)
+
+    results.dump()
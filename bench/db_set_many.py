@@ -0,0 +1,30 @@
+from db_common import parse_args, Results, cleanup, DBFILE
+
+from hexlib.db import PersistentState
+
+
+def _rows(n):
+    return ((i, {"a": i, "b": "hello world %d" % i, "c": i / 3}) for i in range(n))
+
+
+def setitem(table, n):
+    for k, v in _rows(n):
+        table[k] = v
+
+
+def set_many(table, n):
+    table.set_many(_rows(n))
+
+
+if __name__ == '__main__':
+    args = parse_args("Per-row __setitem__ vs batched set_many()", n=20000)
+    results = Results("db_set_many", args)
+
+    # __setitem__: ~1400 rows/s, set_many: ~140000 rows/s
+    for name, func in (("__setitem__", setitem), ("set_many", set_many)):
+        cleanup()
+        with PersistentState(DBFILE) as s:
+            results.measure("sqlite", name, args.n, lambda: func(s["bench"], args.n))
+    cleanup()
+
+    results.dump()
@@ -1,76 +1,331 @@
+import asyncio
+import atexit
 import base64
+import hashlib
+import importlib
+import itertools
+import os
+import re
 import sqlite3
 import traceback
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from enum import Enum
+from queue import Queue, Full, Empty
+from threading import Event, Lock, Thread, local
+from math import ceil, log
+from time import monotonic, sleep
 
+import numpy as np
+import orjson
 import psycopg2
 import umsgpack
 from psycopg2.errorcodes import UNIQUE_VIOLATION
 from pydantic import BaseModel
 
 from hexlib.env import get_redis
+from hexlib.files import COMPRESSION_ZSTD, NDJsonWriter, ndjson_iter
+from hexlib.misc import ichunks, LRUCache, strhash
+from hexlib.serializers import allowed_ids, get_serializer, loads as _redis_loads
 
 
-def _json_encoder(x):
-    if isinstance(x, datetime):
-        return x.isoformat()
-    if isinstance(x, Enum):
-        return x.value
+def _ndjson_encoder(x):
+    if isinstance(x, bytes):
+        return {"__bytes": base64.b64encode(x).decode()}
 
-    raise Exception(f"I don't know how to JSON encode {x} ({type(x)})")
+    raise TypeError(f"I don't know how to JSON encode {x} ({type(x)})")
+
+
+_PYDANTIC_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | \
+                           orjson.OPT_PASSTHROUGH_SUBCLASS | orjson.OPT_PASSTHROUGH_DATACLASS
+
+# (module, class name) -> pydantic model class
+_pydantic_classes = {}
+
+
+def _pydantic_class(module, name):
+    cls = _pydantic_classes.get((module, name))
+    if cls is None:
+        cls = getattr(importlib.import_module(module), name)
+        _pydantic_classes[(module, name)] = cls
+    return cls
+
+
+def _redis_dumps(serializer, value):
+    """serializer=None: untagged umsgpack, readable by older versions"""
+    if serializer is None:
+        return umsgpack.dumps(value)
+    return serializer.dumps(value)
+
+
+class RedisClientCache:
+    """
+    In-process cache of Redis reads, invalidated by the server whenever a key under prefix is modified:
+
+    - "tracking": CLIENT TRACKING in broadcast mode (Redis >= 6), invalidation messages are redirected
+      to a dedicated connection
+    - "keyspace": keyspace notifications, which must be enabled on the server
+      (for example: CONFIG SET notify-keyspace-events Kghs)
+
+    Invalidations are per Redis key (a whole RedisTable). If the invalidation connection is lost,
+    the cache is emptied until it is re-established.
+    """
+
+    def __init__(self, rdb, prefix, max_size=10000, ttl=None, invalidation="tracking", logger=None):
+        if invalidation not in ("tracking", "keyspace"):
+            raise ValueError(f"Unknown invalidation mode: {invalidation}")
+
+        self._rdb = rdb
+        self._prefix = prefix
+        self._invalidation = invalidation
+        self._logger = logger
+        self._cache = LRUCache(max_size, ttl)
+        self.hits = 0
+        self.misses = 0
+
+        # Entries are only valid if they were read at the current (epoch, generation of their key)
+        self._epoch = 0
+        self._generations = {}
+        self._conns = []
+        self._closed = Event()
+
+        self._connect()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        pool = self._rdb.connection_pool
+        listener = pool.get_connection()
+        self._conns = [listener]
+
+        if self._invalidation == "tracking":
+            listener.send_command("CLIENT", "ID")
+            client_id = listener.read_response()
+            listener.send_command("SUBSCRIBE", "__redis__:invalidate")
+            listener.read_response()
+
+            # Tracking stays enabled as long as this connection is open
+            tracker = pool.get_connection()
+            self._conns.append(tracker)
+            tracker.send_command("CLIENT", "TRACKING", "ON", "REDIRECT", client_id, "BCAST", "PREFIX", self._prefix)
+            tracker.read_response()
+        else:
+            db = pool.connection_kwargs.get("db", 0)
+            listener.send_command("PSUBSCRIBE", f"__keyspace@{db}__:{self._prefix}*")
+            listener.read_response()
+
+    def _disconnect(self):
+        for conn in self._conns:
+            conn.disconnect()
+            self._rdb.connection_pool.release(conn)
+        self._conns = []
+
+    def _invalidate_all(self):
+        self._epoch += 1
+        self._cache.clear()
+
+    def _on_message(self, msg):
+        msg_type = msg[0].decode() if isinstance(msg[0], bytes) else msg[0]
+
+        if msg_type == "message":
+            # None: the server flushed its database or dropped the tracking table
+            keys = msg[2]
+            if keys is None:
+                self._invalidate_all()
+            else:
+                for key in keys:
+                    self.invalidate(key.decode() if isinstance(key, bytes) else key)
+        elif msg_type == "pmessage":
+            channel = msg[2].decode() if isinstance(msg[2], bytes) else msg[2]
+            self.invalidate(channel.split(":", 1)[1])
+
+    def _run(self):
+        while not self._closed.is_set():
+            try:
+                listener = self._conns[0]
+                if listener.can_read(timeout=1):
+                    self._on_message(listener.read_response())
+                elif len(self._conns) > 1:
+                    tracker = self._conns[1]
+                    tracker.send_command("PING")
+                    tracker.read_response()
+            except Exception as e:
+                if self._closed.is_set():
+                    break
+                if self._logger:
+                    self._logger.warning(f"Redis client cache invalidation connection lost: {e}")
+                self._invalidate_all()
+                self._disconnect()
+                self._closed.wait(1)
+                try:
+                    self._connect()
+                    self._invalidate_all()
+                except Exception:
+                    self._disconnect()
+
+    def generation(self, key):
+        """Call before reading key from Redis, and pass the result to put()"""
+        return self._epoch, self._generations.get(key, 0)
+
+    def get(self, key, field):
+        entry = self._cache.get((key, field))
+        if entry is not None and entry[0] == self.generation(key) and self._conns:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return _MISSING
+
+    def put(self, key, field, value, generation):
+        self._cache.put((key, field), (generation, value))
+
+    def invalidate(self, key):
+        self._generations[key] = self._generations.get(key, 0) + 1
+
+    def stats(self):
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self._cache.evictions,
+        }
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self._disconnect()
 
 
 class VolatileState:
-    """Quick and dirty volatile dict-like redis wrapper"""
+    """
+    Quick and dirty volatile dict-like redis wrapper
+
+    With cache_size > 0, reads are cached in-process, see RedisClientCache (self.cache)
 
-    def __init__(self, prefix, redis_db=None, sep=""):
+    serializer: name or instance from hexlib.serializers used to write values (default: untagged umsgpack),
+    values written with any serializer can be read back, except pickle unless serializer is a pickle serializer
+    """
+
+    def __init__(self, prefix, redis_db=None, sep="", cache_size=0, cache_ttl=None, cache_invalidation="tracking",
+                 serializer=None):
         if redis_db is None:
             redis_db = get_redis()
         self.rdb = redis_db
         self.prefix = prefix
         self._sep = sep
+        self.serializer = get_serializer(serializer)
+        self._allowed = allowed_ids(self.serializer)
+        self.cache = None
+        if cache_size:
+            self.cache = RedisClientCache(redis_db, prefix, cache_size, cache_ttl, cache_invalidation)
 
     def __getitem__(self, table):
         return RedisTable(self, table, self._sep)
 
     def __delitem__(self, key):
         self.rdb.delete(f"{self.prefix}{self._sep}{key}")
+        if self.cache is not None:
+            self.cache.invalidate(f"{self.prefix}{self._sep}{key}")
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
 
 
 class VolatileQueue:
-    """Quick and dirty volatile queue-like redis wrapper"""
+    """Quick and dirty volatile queue-like redis wrapper (see VolatileState for serializer)"""
 
-    def __init__(self, key, redis_db=None):
+    def __init__(self, key, redis_db=None, serializer=None):
         if redis_db is None:
             redis_db = get_redis()
         self.rdb = redis_db
         self.key = key
+        self.serializer = get_serializer(serializer)
+        self._allowed = allowed_ids(self.serializer)
 
     def put(self, item):
-        self.rdb.sadd(self.key, umsgpack.dumps(item))
+        self.rdb.sadd(self.key, _redis_dumps(self.serializer, item))
 
     def get(self):
         v = self.rdb.spop(self.key)
         if v:
-            return umsgpack.loads(v)
+            return _redis_loads(v, allowed=self._allowed)
+
+    def put_many(self, items, chunk_size=1000):
+        pipe = self.rdb.pipeline(transaction=False)
+        for chunk in ichunks(items, chunk_size):
+            pipe.sadd(self.key, *(_redis_dumps(self.serializer, item) for item in chunk))
+        pipe.execute()
+
+    def get_many(self, n):
+        """Pop up to n items (fewer if the queue is smaller)"""
+        return [_redis_loads(v, allowed=self._allowed) for v in self.rdb.spop(self.key, n)]
+
+    def iter(self, batch_size=1000, idle_timeout=None, max_sleep=1.0):
+        """
+        Drain the queue in batches of up to batch_size, waiting for new items when it is empty.
+        The wait between polls of an empty queue grows exponentially up to max_sleep.
+        Stops once the queue has been empty for idle_timeout seconds (None: never)
+        """
+        sleep_time = 0.01
+        idle_since = None
+        while True:
+            items = self.get_many(batch_size)
+            if items:
+                yield from items
+                sleep_time = 0.01
+                idle_since = None
+                continue
+
+            now = monotonic()
+            if idle_since is None:
+                idle_since = now
+            if idle_timeout is not None:
+                remaining = idle_since + idle_timeout - now
+                if remaining <= 0:
+                    return
+                sleep_time = min(sleep_time, remaining)
+            sleep(sleep_time)
+            sleep_time = min(sleep_time * 2, max_sleep)
 
 
 class VolatileBooleanState:
-    """Quick and dirty volatile dict-like redis wrapper for boolean values"""
+    """
+    Quick and dirty volatile dict-like redis wrapper for boolean values
+
+    backend:
+    - "set": one Redis set per table (exact, any key)
+    - "bitmap": one Redis bitmap per table (exact, non-negative integer keys only, compact for dense ids)
+    - "bloom": scalable Bloom filter (approximate, no deletion), see RedisBloomTable
+
+    With cache_size > 0, reads are cached in-process, see RedisClientCache (self.cache)
+    """
 
-    def __init__(self, prefix, redis_db=None, sep=""):
+    def __init__(self, prefix, redis_db=None, sep="", cache_size=0, cache_ttl=None, cache_invalidation="tracking",
+                 backend="set", bloom_capacity=1000000, bloom_error_rate=0.001):
         if redis_db is None:
             redis_db = get_redis()
+        if backend not in _BOOLEAN_BACKENDS:
+            raise ValueError(f"Unknown backend: {backend}")
         self.rdb = redis_db
         self.prefix = prefix
         self._sep = sep
+        self._table_factory = _BOOLEAN_BACKENDS[backend]
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.cache = None
+        if cache_size:
+            self.cache = RedisClientCache(redis_db, prefix, cache_size, cache_ttl, cache_invalidation)
 
     def __getitem__(self, table):
-        return RedisBooleanTable(self, table, self._sep)
+        return self._table_factory(self, table, self._sep)
 
     def __delitem__(self, table):
-        self.rdb.delete(f"{self.prefix}{self._sep}{table}")
+        self[table].clear()
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
 
 
 class RedisTable:
@@ -80,22 +335,87 @@ class RedisTable:
         self._sep = sep
         self._key = f"{self._state.prefix}{self._sep}{self._table}"
 
+    def _invalidate(self):
+        if self._state.cache is not None:
+            self._state.cache.invalidate(self._key)
+
     def __setitem__(self, key, value):
-        self._state.rdb.hset(self._key, str(key), umsgpack.dumps(value))
+        self._state.rdb.hset(self._key, str(key), _redis_dumps(self._state.serializer, value))
+        self._invalidate()
 
     def __getitem__(self, key):
+        cache = self._state.cache
+        if cache is not None:
+            val = cache.get(self._key, str(key))
+            if val is not _MISSING:
+                return val
+            generation = cache.generation(self._key)
+
         val = self._state.rdb.hget(self._key, str(key))
-        if val:
-            return umsgpack.loads(val)
-        return None
+        val = _redis_loads(val, allowed=self._state._allowed) if val else None
+
+        if cache is not None:
+            cache.put(self._key, str(key), val, generation)
+        return val
 
     def __delitem__(self, key):
         self._state.rdb.hdel(self._key, str(key))
+        self._invalidate()
+
+    def set_many(self, mapping, chunk_size=1000):
+        """Set many fields (dict or iterable of (key, value) pairs), with one HSET per chunk in a single pipeline"""
+        items = mapping.items() if isinstance(mapping, dict) else mapping
+
+        pipe = self._state.rdb.pipeline(transaction=False)
+        for chunk in ichunks(items, chunk_size):
+            pipe.hset(self._key, mapping={str(k): _redis_dumps(self._state.serializer, v) for k, v in chunk})
+        pipe.execute()
+        self._invalidate()
+
+    def get_many(self, keys, chunk_size=1000):
+        """Get the values of many fields (None for missing fields), in the same order as keys"""
+        pipe = self._state.rdb.pipeline(transaction=False)
+        for chunk in ichunks(keys, chunk_size):
+            pipe.hmget(self._key, [str(k) for k in chunk])
+
+        return [
+            _redis_loads(val, allowed=self._state._allowed) if val else None
+            for values in pipe.execute() for val in values
+        ]
+
+    def delete_many(self, keys, chunk_size=1000):
+        pipe = self._state.rdb.pipeline(transaction=False)
+        for chunk in ichunks(keys, chunk_size):
+            pipe.hdel(self._key, *(str(k) for k in chunk))
+        pipe.execute()
+        self._invalidate()
+
+    def iter(self, count=1000):
+        """
+        Iterate over all (key, value) pairs with HSCAN, without blocking the server.
+        Fields are fetched and decoded count at a time (approximately)
+        """
+        cursor = 0
+        while True:
+            cursor, page = self._state.rdb.hscan(self._key, cursor, count=count)
+            yield from zip(page.keys(), (_redis_loads(v, allowed=self._state._allowed) for v in page.values()))
+            if cursor == 0:
+                break
+
+    def keys(self, count=1000):
+        """Iterate over all keys (values are not decoded)"""
+        cursor = 0
+        while True:
+            cursor, page = self._state.rdb.hscan(self._key, cursor, count=count)
+            yield from page.keys()
+            if cursor == 0:
+                break
+
+    def __len__(self):
+        return self._state.rdb.hlen(self._key)
 
     def __iter__(self):
-        for val in self._state.rdb.hscan(self._key):
-            if val:
-                return ((k, umsgpack.loads(v)) for k, v in val.items())
+        return self.iter()
 
 
 class RedisBooleanTable:
@@ -104,43 +424,344 @@ class RedisBooleanTable:
         self._table = table
         self._sep = sep
         self._key = f"{self._state.prefix}{self._sep}{self._table}"
+        # Redis key whose modification invalidates cached reads
+        self._cache_key = self._key
+
+    def _invalidate(self):
+        if self._state.cache is not None:
+            self._state.cache.invalidate(self._cache_key)
 
     def __setitem__(self, key, value):
         if value:
             self._state.rdb.sadd(self._key, str(key))
+            self._invalidate()
         else:
             self.__delitem__(key)
 
-    def __getitem__(self, key):
+    def _get(self, key):
         return self._state.rdb.sismember(self._key, str(key))
 
+    def __getitem__(self, key):
+        cache = self._state.cache
+        if cache is not None:
+            val = cache.get(self._cache_key, str(key))
+            if val is not _MISSING:
+                return val
+            generation = cache.generation(self._cache_key)
+
+        val = self._get(key)
+
+        if cache is not None:
+            cache.put(self._cache_key, str(key), val, generation)
+        return val
+
     def __delitem__(self, key):
         self._state.rdb.srem(self._key, str(key))
+        self._invalidate()
+
+    def set_many(self, keys, value=True, chunk_size=1000):
+        """Set many keys to value, with one SADD (or SREM) per chunk in a single pipeline"""
+        pipe = self._state.rdb.pipeline(transaction=False)
+        for chunk in ichunks(keys, chunk_size):
+            if value:
+                pipe.sadd(self._key, *(str(k) for k in chunk))
+            else:
+                pipe.srem(self._key, *(str(k) for k in chunk))
+        pipe.execute()
+        self._invalidate()
+
+    def get_many(self, keys, chunk_size=1000):
+        """Get the values of many keys, in the same order as keys (requires Redis >= 6.2)"""
+        pipe = self._state.rdb.pipeline(transaction=False)
+        for chunk in ichunks(keys, chunk_size):
+            pipe.smismember(self._key, [str(k) for k in chunk])
+
+        return [bool(val) for values in pipe.execute() for val in values]
+
+    def delete_many(self, keys, chunk_size=1000):
+        self.set_many(keys, value=False, chunk_size=chunk_size)
+
+    def clear(self):
+        self._state.rdb.delete(self._key)
+        self._invalidate()
+
+    def __len__(self):
+        return self._state.rdb.scard(self._key)
 
     def __iter__(self):
         yield from self._state.rdb.sscan_iter(self._key)
 
 
+def _bit_offset(key):
+    offset = int(key)
+    if offset < 0:
+        raise ValueError(f"Bitmap keys must be non-negative integers: {key}")
+    return offset
+
+
+class RedisBitmapTable(RedisBooleanTable):
+    """
+    Boolean table stored as a Redis bitmap, key n is bit n. Keys must be non-negative integers.
+    Memory is proportional to the largest key (max 2^32 bits), so this is best suited for dense ids
+    """
+
+    def _get(self, key):
+        return bool(self._state.rdb.getbit(self._key, _bit_offset(key)))
+
+    def __setitem__(self, key, value):
+        self._state.rdb.setbit(self._key, _bit_offset(key), 1 if value else 0)
+        self._invalidate()
+
+    def __delitem__(self, key):
+        self[key] = False
+
+    def set_many(self, keys, value=True, chunk_size=1000):
+        """Set many keys to value, with one BITFIELD per chunk in a single pipeline"""
+        bit = 1 if value else 0
+        pipe = self._state.rdb.pipeline(transaction=False)
+        for chunk in ichunks(keys, chunk_size):
+            args = []
+            for key in chunk:
+                args.extend(("SET", "u1", _bit_offset(key), bit))
+            pipe.execute_command("BITFIELD", self._key, *args)
+        pipe.execute()
+        self._invalidate()
+
+    def get_many(self, keys, chunk_size=1000):
+        """Get the values of many keys, in the same order as keys"""
+        pipe = self._state.rdb.pipeline(transaction=False)
+        for chunk in ichunks(keys, chunk_size):
+            args = []
+            for key in chunk:
+                args.extend(("GET", "u1", _bit_offset(key)))
+            pipe.execute_command("BITFIELD", self._key, *args)
+
+        return [bool(val) for values in pipe.execute() for val in values]
+
+    def __len__(self):
+        return self._state.rdb.bitcount(self._key)
+
+    def iter(self, chunk_size=1 << 20):
+        """Yields the (int) keys that are set, reading chunk_size bytes of the bitmap at a time"""
+        start = 0
+        while True:
+            chunk = self._state.rdb.getrange(self._key, start, start + chunk_size - 1)
+            if not chunk:
+                break
+            bits = np.unpackbits(np.frombuffer(chunk, dtype=np.uint8))
+            yield from (int(i) + start * 8 for i in np.flatnonzero(bits))
+            if len(chunk) < chunk_size:
+                break
+            start += chunk_size
+
+    def __iter__(self):
+        return self.iter()
+
+
+_BLOOM_SEGMENT_BITS = 1 << 32
+
+
+class RedisBloomTable(RedisBooleanTable):
+    """
+    Scalable Bloom filter (Almeida et al., 2007) stored in plain Redis strings.
+
+    Filter i holds capacity * 2^i keys with a false positive rate of error_rate / 2^(i+1), so that
+    the overall false positive rate stays below error_rate as the filter grows. Membership
+    can be true for keys that were never added (at most error_rate of the time), keys cannot be removed.
+
+    Keys: {key}:n is the number of keys added, {key}:i is the bitmap of filter i. Filters larger than
+    2^32 bits (the maximum size of a Redis string) continue in {key}:i:1, {key}:i:2, ...
+    """
+
+    def __init__(self, state, table, sep=""):
+        super().__init__(state, table, sep)
+        self._capacity = state.bloom_capacity
+        self._error_rate = state.bloom_error_rate
+        self._count_key = f"{self._key}:n"
+        # Every insertion increments the counter
+        self._cache_key = self._count_key
+
+    def _filter(self, i):
+        """(capacity, bits, hashes) of filter i"""
+        capacity = self._capacity << i
+        error_rate = self._error_rate / (2 << i)
+        bits = ceil(-capacity * log(error_rate) / (log(2) ** 2))
+        hashes = max(1, round(bits / capacity * log(2)))
+        return capacity, bits, hashes
+
+    def _filter_index(self, n):
+        """Index of the filter that receives the n-th key (0-based)"""
+        i = 0
+        while n >= self._capacity << i:
+            n -= self._capacity << i
+            i += 1
+        return i
+
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+    def _offsets(self, i, h):
+        _, bits, hashes = self._filter(i)
+        h1, h2 = h
+        return [(h1 + j * h2) % bits for j in range(hashes)]
+
+    def _segment_key(self, i, segment):
+        return f"{self._key}:{i}" if segment == 0 else f"{self._key}:{i}:{segment}"
+
+    def _bitfield_args(self, pairs, op):
+        """
+        [(filter index, hash)] -> ({redis key: BITFIELD arguments}, {redis key: [index in pairs of each bit]})
+        Filters larger than a Redis string (2^32 bits) are split in segments
+        """
+        args = {}
+        owners = {}
+        for n, (i, h) in enumerate(pairs):
+            for offset in self._offsets(i, h):
+                segment, offset = divmod(offset, _BLOOM_SEGMENT_BITS)
+                key = self._segment_key(i, segment)
+                args.setdefault(key, []).extend(op(offset))
+                owners.setdefault(key, []).append(n)
+        return args, owners
+
+    def _count(self):
+        return int(self._state.rdb.get(self._count_key) or 0)
+
+    def _contains_many(self, hashes, filters):
+        """One BITFIELD GET per filter (segment) for the whole chunk"""
+        if not hashes:
+            return []
+
+        pairs = [(i, h) for i in range(filters) for h in hashes]
+        args, owners = self._bitfield_args(pairs, lambda offset: ("GET", "u1", offset))
+
+        pipe = self._state.rdb.pipeline(transaction=False)
+        for key, key_args in args.items():
+            pipe.execute_command("BITFIELD", key, *key_args)
+
+        # A key is in filter i if all of its bits are set
+        unset = set()
+        for key, values in zip(args.keys(), pipe.execute()):
+            unset.update(n for n, value in zip(owners[key], values) if not value)
+
+        found = [False] * len(hashes)
+        for n in range(len(pairs)):
+            if n not in unset:
+                found[n % len(hashes)] = True
+        return found
+
+    def _get(self, key):
+        return self.get_many([key])[0]
+
+    def __setitem__(self, key, value):
+        self.set_many([key], value)
+
+    def __delitem__(self, key):
+        raise NotImplementedError("Keys cannot be removed from a Bloom filter")
+
+    def set_many(self, keys, value=True, chunk_size=1000):
+        """
+        Add many keys. Keys that are (probably) already present are skipped so that they do not use up capacity
+        """
+        if not value:
+            raise NotImplementedError("Keys cannot be removed from a Bloom filter")
+
+        for chunk in ichunks(keys, chunk_size):
+            hashes = list({h: None for h in map(self._hash, chunk)})
+            n = self._count()
+            found = self._contains_many(hashes, self._filter_index(n) + 1)
+            new = [h for h, f in zip(hashes, found) if not f]
+            if not new:
+                continue
+
+            # Reserve positions atomically so that concurrent writers never place more keys in a filter
+            # than its capacity
+            start = self._state.rdb.incrby(self._count_key, len(new)) - len(new)
+            pairs = [(self._filter_index(start + j), h) for j, h in enumerate(new)]
+            args, _ = self._bitfield_args(pairs, lambda offset: ("SET", "u1", offset, 1))
+
+            pipe = self._state.rdb.pipeline(transaction=False)
+            for key, key_args in args.items():
+                pipe.execute_command("BITFIELD", key, *key_args)
+            pipe.execute()
+        self._invalidate()
+
+    def get_many(self, keys, chunk_size=1000):
+        """Check the membership of many keys, in the same order as keys (may contain false positives)"""
+        filters = self._filter_index(self._count()) + 1
+        result = []
+        for chunk in ichunks(keys, chunk_size):
+            result.extend(self._contains_many([self._hash(k) for k in chunk], filters))
+        return result
+
+    def delete_many(self, keys, chunk_size=1000):
+        raise NotImplementedError("Keys cannot be removed from a Bloom filter")
+
+    def clear(self):
+        filters = self._filter_index(self._count()) + 1
+        self._state.rdb.delete(self._count_key, *(
+            self._segment_key(i, segment)
+            for i in range(filters)
+            for segment in range(ceil(self._filter(i)[1] / _BLOOM_SEGMENT_BITS))
+        ))
+        self._invalidate()
+
+    def __len__(self):
+        """Approximate number of distinct keys added"""
+        return self._count()
+
+    def __iter__(self):
+        raise NotImplementedError("Bloom filters cannot be iterated")
+
+
+_BOOLEAN_BACKENDS = {
+    "set": RedisBooleanTable,
+    "bitmap": RedisBitmapTable,
+    "bloom": RedisBloomTable,
+}
+
+
 class Table:
     def __init__(self, state, table):
         self._state = state
         self._table = table
+        self._buffer = state._write_behind
+
+    def buffered(self, max_items=10000, interval=1.0):
+        """
+        Get a copy of this table whose writes are queued in memory and flushed in the background
+        (see WriteBehindBuffer). Pending writes are flushed on flush(), on context exit and at exit
+        """
+        table = self._state._table_factory(self._state, self._table)
+        table._buffer = WriteBehindBuffer(self._state, max_items=max_items, interval=interval)
+        return table
+
+    def flush(self):
+        if self._buffer is not None:
+            self._buffer.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._buffer is self._state._write_behind:
+            self.flush()
+        elif self._buffer is not None:
+            self._buffer.close()
 
     def _sql_dict(self, where_clause, *params):
-        with sqlite3.connect(self._state.dbfile, **self._state.dbargs) as conn:
-            conn.row_factory = sqlite3.Row
-            try:
-                col_types = conn.execute("PRAGMA table_info(%s)" % self._table).fetchall()
-                cur = conn.execute("SELECT * FROM %s %s" % (self._table, where_clause), params)
-                for row in cur:
-                    yield dict(
-                        (col[0], _deserialize(row[col[0]], col_types[i]["type"]))
-                        for i, col in enumerate(cur.description)
-                    )
-            except:
-                return None
+        conn = self._state.connection()
+        try:
+            cur = conn.execute("SELECT * FROM %s %s" % (self._table, where_clause), params)
+            decode = self._state._row_decoder(conn, self._table, cur.description)
+            for row in cur:
+                yield decode(row)
+        except:
+            return None
 
     def sql(self, where_clause, *params):
+        self.flush()
         for row in self._sql_dict(where_clause, *params):
             if row and "__pydantic" in row:
                 yield self._deserialize_pydantic(row)
@@ -148,103 +769,641 @@ class Table:
                 yield row
 
     def _iter_dict(self):
-        with sqlite3.connect(self._state.dbfile, **self._state.dbargs) as conn:
-            conn.row_factory = sqlite3.Row
-            try:
-                col_types = conn.execute("PRAGMA table_info(%s)" % self._table).fetchall()
-                cur = conn.execute("SELECT * FROM %s" % (self._table,))
-                for row in cur:
-                    yield dict(
-                        (col[0], _deserialize(row[col[0]], col_types[i]["type"]))
-                        for i, col in enumerate(cur.description)
-                    )
-            except:
-                return None
+        conn = self._state.connection()
+        try:
+            cur = conn.execute("SELECT * FROM %s" % (self._table,))
+            decode = self._state._row_decoder(conn, self._table, cur.description)
+            for row in cur:
+                yield decode(row)
+        except:
+            return None
 
     def __iter__(self):
+        self.flush()
         for row in self._iter_dict():
             if row and "__pydantic" in row:
                 yield self._deserialize_pydantic(row)
             else:
                 yield row
 
-    def _getitem_dict(self, key):
-        with sqlite3.connect(self._state.dbfile, **self._state.dbargs) as conn:
-            conn.row_factory = sqlite3.Row
+    def iter(self, columns=None, batch_size=1000, where=None, params=(), order_by="id"):
+        """
+        Iterate over the rows in batches, with keyset pagination (no read transaction is held between batches)
+
+        :param columns: Columns to select (all by default). id and the order_by column are always selected.
+        Pydantic rows are only deserialized when all columns are selected
+        :param where: SQL condition (without the WHERE keyword), with ? placeholders for params
+        :param order_by: "id", or "<column>" / "<column> DESC" (ties are ordered by id)
+        """
+
+        self.flush()
+
+        tokens = order_by.split()
+        order_col = tokens[0]
+        desc = len(tokens) > 1 and tokens[1].upper() == "DESC"
+        op = "<" if desc else ">"
+        direction = " DESC" if desc else ""
+
+        if columns is None:
+            select = "*"
+        else:
+            select = ",".join(dict.fromkeys(["id", order_col, *columns]))
+
+        if order_col == "id":
+            order = "id%s" % direction
+        else:
+            order = "%s%s,id%s" % (order_col, direction, direction)
+
+        last = None
+
+        while True:
+            # Each batch is fetched with the connection of the current thread, the generator can be
+            # resumed from different threads
+            conn = self._state.connection()
+            conditions = []
+            args = []
+            if where:
+                conditions.append("(%s)" % where)
+                args.extend(params)
+
+            if last is not None:
+                last_id, last_value = last
+                if order_col == "id":
+                    conditions.append("id %s ?" % op)
+                    args.append(last_id)
+                # NULLs come first in ascending order, and last in descending order
+                elif last_value is None and not desc:
+                    conditions.append("((%s IS NULL AND id > ?) OR %s IS NOT NULL)" % (order_col, order_col))
+                    args.append(last_id)
+                elif last_value is None:
+                    conditions.append("(%s IS NULL AND id < ?)" % order_col)
+                    args.append(last_id)
+                else:
+                    conditions.append("((%s,id) %s (?,?)%s)" % (
+                        order_col, op, " OR %s IS NULL" % order_col if desc else ""
+                    ))
+                    args.extend((last_value, last_id))
+
+            sql = "SELECT %s FROM %s %s ORDER BY %s LIMIT %d" % (
+                select, self._table, "WHERE " + " AND ".join(conditions) if conditions else "", order, batch_size
+            )
             try:
-                col_types = conn.execute("PRAGMA table_info(%s)" % self._table).fetchall()
-                cur = conn.execute("SELECT * FROM %s WHERE id=?" % (self._table,), (key,))
-
-                row = cur.fetchone()
-                if row:
-                    return dict(
-                        (col[0], _deserialize(row[col[0]], col_types[i]["type"]))
-                        for i, col in enumerate(cur.description)
-                    )
-            except:
-                return None
+                cur = conn.execute(sql, args)
+                rows = cur.fetchall()
+            except sqlite3.OperationalError:
+                return
 
-    @staticmethod
-    def _deserialize_pydantic(row):
-        module = __import__(row["__module"])
-        cls = getattr(module, row["__class"])
-        return cls.parse_raw(row["json"])
+            if not rows:
+                return
+
+            decode = self._state._row_decoder(conn, self._table, cur.description)
+            for row in rows:
+                row = decode(row)
+                if columns is None and "__pydantic" in row:
+                    yield self._deserialize_pydantic(row)
+                else:
+                    yield row
+
+            last = (rows[-1]["id"], rows[-1][order_col])
+            if len(rows) < batch_size:
+                return
+
+    def keys(self, batch_size=10000):
+        for row in self.iter(columns=["id"], batch_size=batch_size):
+            yield row["id"]
+
+    def _raw_iter(self, batch_size=1000):
+        """Same as iter(), without deserializing pydantic rows"""
+        columns = list(self._state._schema(self._state.connection(), self._table))
+        if columns:
+            yield from self.iter(columns=columns, batch_size=batch_size)
+
+    def to_columns(self, columns, dtypes=None, where=None, params=(), batch_size=10000):
+        """
+        Read columns into numpy arrays, batch by batch, without building a dict per row.
+
+        :param dtypes: {column: dtype}. By default, integer columns are int64 (float64 with NaN if they contain NULLs),
+        real columns are float64 and other columns are object arrays
+        :param where: SQL condition (without the WHERE keyword), with ? placeholders for params
+        :return: {column: array}
+        """
+
+        self.flush()
+        dtypes = dtypes or {}
+        conn = self._state.connection()
+        schema = self._state._schema(conn, self._table)
+
+        col_dtypes = []
+        for col in columns:
+            col_type = schema.get(col, "").lower()
+            col_dtypes.append(np.dtype(dtypes.get(col, _NUMPY_DTYPES.get(col_type, object))))
+
+        if not schema:
+            return {col: np.empty(0, dtype=dtype) for col, dtype in zip(columns, col_dtypes)}
+
+        where_clause = "WHERE %s" % where if where else ""
+        size = conn.execute("SELECT COUNT(*) FROM %s %s" % (self._table, where_clause), params).fetchone()[0]
+        arrays = [np.empty(size, dtype=dtype) for dtype in col_dtypes]
+        decoders = [self._state._col_decoders.get(schema.get(col, "").lower()) for col in columns]
+
+        cur = conn.cursor()
+        cur.row_factory = None
+        cur.execute("SELECT %s FROM %s %s" % (",".join(columns), self._table, where_clause), params)
+
+        offset = 0
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+
+            end = offset + len(rows)
+            if end > arrays[0].shape[0]:
+                # Rows were added since COUNT(*)
+                arrays = [np.resize(arr, max(end, arr.shape[0] * 2)) for arr in arrays]
+
+            for i, values in enumerate(zip(*rows)):
+                if decoders[i] is not None and arrays[i].dtype == object:
+                    values = [decoders[i](v) if v is not None else None for v in values]
+                try:
+                    arrays[i][offset:end] = values
+                except TypeError:
+                    if arrays[i].dtype.kind not in "iu" or columns[i] in dtypes:
+                        raise
+                    # NULL in an integer column
+                    arrays[i] = arrays[i].astype(np.float64)
+                    arrays[i][offset:end] = np.array(values, dtype=np.float64)
+            offset = end
+
+        return {col: arr[:offset] for col, arr in zip(columns, arrays)}
+
+    def export_ndjson(self, path, compression=COMPRESSION_ZSTD, level=3, threads=0, batch_size=10000):
+        """
+        Stream the rows of this table to a NDJSON file (compression: "zstd", "gz" or "").
+        bytes values are exported as {"__bytes": "<base64>"}, pydantic rows are exported as stored
+
+        :param threads: number of zstd compression threads (0: compress in the calling thread)
+        :return: number of exported rows
+        """
+
+        self.flush()
+
+        cnt = 0
+        with NDJsonWriter(path, compression=compression, level=level, threads=threads,
+                          default=_ndjson_encoder) as writer:
+            for row in self._raw_iter(batch_size=batch_size):
+                writer.write(row)
+                cnt += 1
+        return cnt
+
+    def import_ndjson(self, path, compression=COMPRESSION_ZSTD, batch_size=10000):
+        """
+        Import rows from a NDJSON file written by export_ndjson(), in batched transactions
+
+        :return: number of imported rows
+        """
+
+        cnt = 0
+
+        def rows():
+            nonlocal cnt
+            for line in ndjson_iter(path, compression=compression):
+                row = line.json()
+                key = row.pop("id")
+                for k, v in row.items():
+                    if isinstance(v, dict) and "__bytes" in v:
+                        row[k] = base64.b64decode(v["__bytes"])
+                cnt += 1
+                yield key, row
+
+        self.set_many(rows(), batch_size=batch_size)
+        return cnt
+
+    def __len__(self):
+        self.flush()
+        try:
+            return self._state.connection().execute("SELECT COUNT(*) FROM %s" % self._table).fetchone()[0]
+        except sqlite3.OperationalError:
+            return 0
+
+    def create_index(self, *columns, unique=False):
+        """
+        Create an index on one or more columns. Indexes are saved in the index catalog of the database
+        and re-created along with the table and its columns if they don't exist yet
+        """
+
+        name = "%s_%s_idx" % (self._table, "_".join(columns))
+
+        conn = self._state.connection()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS %s (name text primary key, tbl text, columns text, is_unique integer)"
+                % INDEX_CATALOG
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO %s (name, tbl, columns, is_unique) VALUES (?,?,?,?)" % INDEX_CATALOG,
+                (name, self._table, ",".join(columns), int(unique))
+            )
+            self._state._apply_indexes(conn, self._table)
+
+        return name
+
+    def drop_index(self, *columns):
+        name = "%s_%s_idx" % (self._table, "_".join(columns))
+
+        conn = self._state.connection()
+        with conn:
+            conn.execute("DROP INDEX IF EXISTS %s" % name)
+            try:
+                conn.execute("DELETE FROM %s WHERE name=?" % INDEX_CATALOG, (name,))
+            except sqlite3.OperationalError:
+                pass
+
+    def explain(self, where_clause, *params):
+        """
+        Get the query plan of sql(where_clause, *params)
+
+        :return: {"plan": [<EXPLAIN QUERY PLAN details>],
+                  "uses_index": <True if rows are looked up with an index or the primary key (SEARCH)>,
+                  "full_scan": <True if the table or an index is scanned (SCAN), ex. an index only used for ORDER BY>}
+        """
+
+        conn = self._state.connection()
+        # EXPLAIN statements are not prepared again when the schema changes (ex. drop_index()), so cached
+        # statements are only reused for the same schema version
+        schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+        plan = [
+            row["detail"] for row in
+            conn.execute("EXPLAIN QUERY PLAN SELECT * FROM %s %s /* schema %d */" % (
+                self._table, where_clause, schema_version
+            ), params)
+        ]
+
+        return {
+            "plan": plan,
+            "uses_index": any(d.startswith("SEARCH ") for d in plan),
+            "full_scan": any(d.startswith("SCAN ") for d in plan),
+        }
+
+    def _getitem_dict(self, key):
+        conn = self._state.connection()
+        try:
+            cur = conn.execute("SELECT * FROM %s WHERE id=?" % (self._table,), (key,))
+
+            row = cur.fetchone()
+            if row:
+                return self._state._row_decoder(conn, self._table, cur.description)(row)
+        except:
+            return None
+
+    def _deserialize_pydantic(self, row):
+        cls = _pydantic_class(row["__module"], row["__class"])
+        obj = orjson.loads(row["json"])
+        if self._state.trusted_pydantic:
+            return cls.construct(**obj)
+        return cls.parse_obj(obj)
+
+    def _pending_row(self, key, op):
+        action, value = op
+        if action == _DELETE:
+            return None
+
+        # Pending values are returned as they will be read back once flushed
+        schema = self._state._schema(self._state.connection(), self._table) or {}
+        value = {k: _stored_value(v, schema.get(k) or _sqlite_type(v)) for k, v in value.items()}
+
+        row = None
+        if action == _SET:
+            row = self._getitem_dict(key)
+        row = {**row, **value} if row else {"id": key, **value}
+
+        if "__pydantic" in row:
+            return self._deserialize_pydantic(row)
+        return row
 
     def __getitem__(self, key):
+        if self._buffer is not None:
+            op = self._buffer.pending(self._table, key)
+            if op is not None:
+                return self._pending_row(key, op)
+
+        cache = self._state.cache
+        if cache is not None:
+            cache_key = (self._table, str(key))
+            value = cache.get(cache_key, _MISSING)
+            if value is not _MISSING:
+                return value
+            generation = self._state._cache_generation(cache_key)
+
         row = self._getitem_dict(key)
         if row and "__pydantic" in row:
-            return self._deserialize_pydantic(row)
+            row = self._deserialize_pydantic(row)
+
+        if cache is not None:
+            self._state._cache_put(cache_key, row, generation)
         return row
 
-    def setitem_pydantic(self, key, value: BaseModel):
-        self.__setitem__(key, {
-            "json": value.json(encoder=_json_encoder, indent=2),
+    def _invalidate(self, key):
+        if self._state.cache is not None:
+            self._state._cache_invalidate((self._table, str(key)))
+
+    @staticmethod
+    def _pydantic_dict(value: BaseModel):
+        return {
+            # pydantic's encoder handles sets, Decimal, ... and Config.json_encoders
+            "json": orjson.dumps(
+                value.dict(), default=value.__json_encoder__, option=_PYDANTIC_ORJSON_OPTIONS
+            ).decode(),
             "__class": value.__class__.__name__,
             "__module": value.__class__.__module__,
             "__pydantic": 1
-        })
+        }
+
+    def setitem_pydantic(self, key, value: BaseModel):
+        self.__setitem__(key, self._pydantic_dict(value))
+
+    def _ensure_columns(self, conn, key, value):
+        schema = self._state._schema(conn, self._table)
+
+        if not schema:
+            key_type = "integer" if isinstance(key, int) else "text"
+            conn.execute(
+                "create table if not exists %s (id %s primary key%s)" %
+                (self._table, key_type, "".join(",%s %s" % (k, _sqlite_type(v)) for k, v in value.items()))
+            )
+            self._state._invalidate_schema(self._table)
+            self._state._apply_indexes(conn, self._table)
+            return
+
+        missing = [k for k in value.keys() if k not in schema]
+        if missing:
+            # Our cached schema might be out of date if another connection altered the table
+            self._state._invalidate_schema(self._table)
+            schema = self._state._schema(conn, self._table)
+
+            for k in missing:
+                if k not in schema:
+                    conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (self._table, k, _sqlite_type(value[k])))
+            self._state._invalidate_schema(self._table)
+            self._state._apply_indexes(conn, self._table)
+
+    def _upsert_many(self, conn, columns, rows):
+        """INSERT ... ON CONFLICT DO UPDATE: columns that are not in the row keep their current value"""
+        if columns:
+            on_conflict = "DO UPDATE SET %s" % ",".join("%s=excluded.%s" % (c, c) for c in columns)
+        else:
+            on_conflict = "DO NOTHING"
+
+        sql = "INSERT INTO %s (id%s) VALUES (?%s) ON CONFLICT(id) %s" % (
+            self._table, "".join("," + c for c in columns), ",?" * len(columns), on_conflict
+        )
+        conn.executemany(sql, rows)
+
+    def _write(self, conn, key, value, rows):
+        """_ensure_columns() then _upsert_many(), the cached schema is refreshed if the table changed under us"""
+        columns = tuple(value.keys())
+        try:
+            self._ensure_columns(conn, key, value)
+            self._upsert_many(conn, columns, rows)
+        except sqlite3.OperationalError:
+            # Table dropped or altered by another connection since we cached its schema
+            self._state._invalidate_schema(self._table)
+            self._ensure_columns(conn, key, value)
+            self._upsert_many(conn, columns, rows)
+
+    def _set_batch(self, conn, batch):
+        # Consecutive rows with the same column set are a single executemany(). Groups are written
+        # in input order so that later writes to the same key win
+        group = None
+        for key, value in batch:
+            if isinstance(value, BaseModel):
+                value = self._pydantic_dict(value)
+            if group is None or tuple(group[1].keys()) != tuple(value.keys()):
+                if group is not None:
+                    self._write(conn, *group)
+                group = (key, value, [])
+            group[2].append([key, *(_serialize(v, self._state.base64_blobs) for v in value.values())])
+
+        if group is not None:
+            self._write(conn, *group)
+
+    def _delete_batch(self, conn, keys):
+        try:
+            conn.executemany("DELETE FROM %s WHERE id=?" % self._table, ((key,) for key in keys))
+        except sqlite3.OperationalError:
+            pass
+
+    def set_many(self, items, batch_size=10000):
+        """
+        Insert or update many (key, value) pairs, one transaction per batch.
+        Values can be dicts or pydantic models, the table and missing columns are created as needed
+        """
+
+        if self._buffer is not None:
+            for key, value in items:
+                self.__setitem__(key, value)
+            return
+
+        conn = self._state.connection()
+
+        for batch in ichunks(items, batch_size):
+            with conn:
+                self._set_batch(conn, batch)
+
+            if self._state.cache is not None:
+                for key, _ in batch:
+                    self._invalidate(key)
+
+    def update(self, mapping, batch_size=10000):
+        """Same as set_many(), with a dict of key -> value"""
+        self.set_many(mapping.items(), batch_size=batch_size)
 
     def __setitem__(self, key, value):
 
+        if self._buffer is not None:
+            if isinstance(value, BaseModel):
+                value = self._pydantic_dict(value)
+            self._buffer.set(self._table, key, value)
+            self._invalidate(key)
+            return
+
         if isinstance(value, BaseModel):
             self.setitem_pydantic(key, value)
             return
 
-        with sqlite3.connect(self._state.dbfile, **self._state.dbargs) as conn:
-            conn.row_factory = sqlite3.Row
+        conn = self._state.connection()
+        with conn:
+            self._write(conn, key, value, (
+                [key, *(_serialize(v, self._state.base64_blobs) for v in value.values())],
+            ))
 
-            sql = "INSERT INTO %s (id,%s) VALUES ('%s',%s)" % \
-                  (self._table, ",".join(value.keys()), key, ",".join("?" for _ in value.values()))
-            try:
-                conn.execute(sql, list(_serialize(v) for v in value.values()))
-            except sqlite3.OperationalError:
-                if isinstance(key, int):
-                    key_type = "integer"
-                else:
-                    key_type = "text"
-                conn.execute(
-                    "create table if not exists %s (id %s primary key,%s)" %
-                    (self._table, key_type, ",".join("%s %s" % (k, _sqlite_type(v)) for k, v in value.items()))
-                )
-                conn.execute(sql, list(_serialize(v) for v in value.values()))
-
-            except sqlite3.IntegrityError:
-                sql = "UPDATE %s SET (%s) = (%s) WHERE id=?" \
-                      % (self._table, ",".join(value.keys()), ",".join("?" for _ in value.values()))
-                args = list(_serialize(v) for v in value.values())
-                args.append(key)
-                conn.execute(
-                    sql,
-                    args
-                )
+        self._invalidate(key)
 
     def __delitem__(self, key):
-        with sqlite3.connect(self._state.dbfile, **self._state.dbargs) as conn:
+        if self._buffer is not None:
+            self._buffer.delete(self._table, key)
+            self._invalidate(key)
+            return
+
+        conn = self._state.connection()
+        with conn:
             try:
                 conn.execute("DELETE FROM %s WHERE id=?" % self._table, (key,))
             except sqlite3.OperationalError:
                 pass
 
+        if self._state.cache is not None:
+            self._state._cache_invalidate((self._table, str(key)), None)
+
+
+_SET = "set"
+_REPLACE = "replace"
+_DELETE = "delete"
+
+
+def _compose(old, new):
+    """Combine two pending operations on the same row into one"""
+    if old is None or new[0] != _SET:
+        return new
+    if old[0] == _DELETE:
+        return _REPLACE, new[1]
+    return old[0], {**old[1], **new[1]}
+
+
+class WriteBehindBuffer:
+    """
+    Queues Table writes in memory and flushes them in batched transactions from a background thread,
+    every interval seconds or as soon as max_items rows are pending.
+    Pending writes are visible to Table.__getitem__, and are flushed before Table scans.
+    """
+
+    def __init__(self, state, max_items=10000, interval=1.0):
+        self._state = state
+        self.max_items = max_items
+        self.interval = interval
+        self._init()
+
+    def _init(self):
+        self._pid = os.getpid()
+        # (table, key) -> (action, value)
+        self._pending = {}
+        self._flushing = {}
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+        self._stop = None
+
+    def _put(self, table, key, op):
+        if self._pid != os.getpid():
+            # Pending writes inherited from the parent process are flushed by the parent
+            self._init()
+
+        with self._lock:
+            self._pending[(table, key)] = _compose(self._pending.get((table, key)), op)
+            size = len(self._pending)
+
+            if self._thread is None:
+                self._stop = Event()
+                self._thread = Thread(target=self._run, args=(self._stop,), daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+        if size >= self.max_items * 2:
+            # The background thread can't keep up
+            self.flush()
+        elif size >= self.max_items:
+            self._wakeup.set()
+
+    def set(self, table, key, value: dict):
+        self._put(table, key, (_SET, dict(value)))
+
+    def delete(self, table, key):
+        self._put(table, key, (_DELETE, None))
+
+    def pending(self, table, key):
+        """Get the pending (action, value) operation for this row, if any"""
+        with self._lock:
+            op = self._pending.get((table, key))
+            flushing = self._flushing.get((table, key))
+        if flushing is not None:
+            return _compose(flushing, op) if op is not None else flushing
+        return op
+
+    def _run(self, stop):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if stop.is_set():
+                break
+            try:
+                self.flush()
+            except Exception as e:
+                if self._state.logger:
+                    self._state.logger.error(f"Could not flush pending writes: {e}")
+
+    def _write(self, ops):
+        by_table = {}
+        for (table, key), op in ops.items():
+            by_table.setdefault(table, []).append((key, op))
+
+        conn = self._state.connection()
+        with conn:
+            for table, items in by_table.items():
+                t = self._state._table_factory(self._state, table)
+                t._delete_batch(conn, [key for key, op in items if op[0] != _SET])
+                t._set_batch(conn, [(key, op[1]) for key, op in items if op[0] != _DELETE])
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+
+            try:
+                self._write(self._flushing)
+            except:
+                # Put back the writes that could not be flushed, in front of the ones queued since
+                with self._lock:
+                    for k, op in self._pending.items():
+                        self._flushing[k] = _compose(self._flushing.get(k), op)
+                    self._pending, self._flushing = self._flushing, {}
+                raise
+
+            with self._lock:
+                flushed, self._flushing = self._flushing, {}
+
+        if self._state.cache is not None:
+            for table, key in flushed:
+                self._state._cache_invalidate((table, str(key)))
+
+    def close(self):
+        """Stop the background thread and flush pending writes. The buffer can still be used afterwards"""
+
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._stop.set()
+        self._wakeup.set()
+
+        if thread is not None:
+            atexit.unregister(self.close)
+            thread.join()
+        self.flush()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in ("_pid", "_pending", "_flushing", "_lock", "_flush_lock", "_wakeup", "_thread", "_stop"):
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init()
+
 
 def _sqlite_type(value):
     if isinstance(value, int):
@@ -256,9 +1415,9 @@ def _sqlite_type(value):
     return "text"
 
 
-def _serialize(value):
+def _serialize(value, base64_blobs=False):
     if isinstance(value, bytes):
-        return base64.b64encode(value)
+        return base64.b64encode(value) if base64_blobs else value
     if value is None:
         return None
     if isinstance(value, bool):
@@ -266,32 +1425,795 @@ def _serialize(value):
     return str(value)
 
 
-def _deserialize(value, col_type):
-    if col_type.lower() == "blob":
-        return base64.b64decode(value)
+_MISSING = object()
+
+# Default numpy dtypes of Table.to_columns(), by column type
+_NUMPY_DTYPES = {
+    "integer": np.int64,
+    "real": np.float64,
+}
+
+# Column type -> function applied to non-null values of that column when reading rows
+_BASE64_COL_DECODERS = {
+    "blob": base64.b64decode,
+}
+
+
+# Named sets of PRAGMAs applied to every new PersistentState connection, in order
+SQLITE_PROFILES = {
+    # Durable, but readers don't block writers (and vice versa)
+    "safe": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+    },
+    # Can lose the last transactions on power loss, but the database stays consistent
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 268435456,
+        "cache_size": -65536,
+        "temp_store": "MEMORY",
+    },
+    # For processes that only read (write attempts raise sqlite3.OperationalError)
+    "readonly-mmap": {
+        "query_only": 1,
+        "mmap_size": 1073741824,
+        "cache_size": -65536,
+        "temp_store": "MEMORY",
+    },
+}
+
+# Table holding the indexes created with Table.create_index()
+INDEX_CATALOG = "__hexlib_indexes"
+
+_CACHE_STRIPES = 1024
+
+# PRAGMA user_version of databases converted by migrate_base64_blobs()
+_NATIVE_BLOBS_VERSION = 1
+
+
+def _make_row_decoder(names, schema, col_decoders):
+    decoders = tuple(
+        (name, col_decoders[schema[name].lower()])
+        for name in names if schema.get(name, "").lower() in col_decoders
+    )
+
+    if not decoders:
+        def decode(row):
+            return dict(zip(names, row))
+    else:
+        def decode(row):
+            d = dict(zip(names, row))
+            for name, func in decoders:
+                if d[name] is not None:
+                    d[name] = func(d[name])
+            return d
+
+    return decode
+
+
+_NUMERIC_TEXT = re.compile(r"\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*")
+
+
+def _stored_value(value, column_type):
+    """value as it is read back once written to a column of column_type (see SQLite type affinity)"""
+    value = _serialize(value)
+    if isinstance(value, bool):
+        value = int(value)
+
+    column_type = column_type.lower()
+    if column_type == "text" and isinstance(value, int):
+        return str(value)
+    if column_type not in ("integer", "real"):
+        return value
+
+    if isinstance(value, str) and _NUMERIC_TEXT.fullmatch(value):
+        try:
+            value = int(value)
+        except ValueError:
+            value = float(value)
+            if column_type == "integer" and value.is_integer() and abs(value) < 2 ** 63:
+                value = int(value)
+    if isinstance(value, int) and (column_type == "real" or not -2 ** 63 <= value < 2 ** 63):
+        return float(value)
     return value
 
 
+class _Connection(sqlite3.Connection):
+    # sqlite3.Connection does not support weak references, subclasses do
+    pass
+
+
+# All the open PersistentState connections. A forked child must never use or close the connections of its
+# parent, not even by garbage-collecting them: they are referenced by _inherited_connections forever
+_connections = weakref.WeakSet()
+_inherited_connections = []
+
+
+def _before_fork():
+    _inherited_connections.extend(_connections)
+
+
+def _after_fork_in_parent():
+    _inherited_connections.clear()
+
+
+def _after_fork_in_child():
+    _connections.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(
+        before=_before_fork, after_in_parent=_after_fork_in_parent, after_in_child=_after_fork_in_child
+    )
+
+
 class PersistentState:
-    """Quick and dirty persistent dict-like SQLite wrapper"""
+    """Quick and dirty persistent dict-like SQLite wrapper
+
+    Each thread gets its own SQLite connection, which is reused across calls until close().
+    Connections inherited from a parent process are never reused nor closed, a forked child opens its own.
 
-    def __init__(self, dbfile="state.db", logger=None, table_factory=Table, **dbargs):
+    bytes values are stored as native BLOBs. Databases written by older versions (base64-encoded blobs)
+    can be opened with base64_blobs=True, or converted once with migrate_base64_blobs() (opening them
+    without either raises ValueError)
+
+    profile is the name of one of SQLITE_PROFILES (or a dict of PRAGMAs), applied to each new connection
+
+    With cache_size > 0, Table lookups (including missing keys) go through an in-process LRU cache
+    (see self.cache.stats()). Writes made through this instance invalidate it, writes made by other
+    processes are only seen once the entry expires (cache_ttl, in seconds).
+    Cached values are shared between callers and should not be modified in-place.
+
+    With write_behind=True (or a dict of WriteBehindBuffer options), writes to all tables are
+    buffered in memory and flushed in batches from a background thread, and on close()
+
+    With trusted_pydantic=True, pydantic rows are read with construct() instead of being validated.
+    This is much faster, but nested models and non-JSON types (datetime, Enum...) are not converted
+    """
+
+    def __init__(self, dbfile="state.db", logger=None, table_factory=Table, base64_blobs=False, profile=None,
+                 cache_size=0, cache_ttl=None, write_behind=None, trusted_pydantic=False, **dbargs):
         self.dbfile = dbfile
         self.logger = logger
+        if isinstance(profile, str):
+            if profile not in SQLITE_PROFILES:
+                raise ValueError(f"Unknown profile: {profile}. Available profiles: {', '.join(SQLITE_PROFILES)}")
+            profile = SQLITE_PROFILES[profile]
+        self._pragmas = profile or {}
         if dbargs is None or dbargs == {}:
             dbargs = {"timeout": 30000}
         self.dbargs = dbargs
         self._table_factory = table_factory
+        self.base64_blobs = base64_blobs
+        self.trusted_pydantic = trusted_pydantic
+        self._col_decoders = _BASE64_COL_DECODERS if base64_blobs else {}
+        self.cache = LRUCache(cache_size, cache_ttl) if cache_size else None
+        # Reads only fill the cache if no write invalidated their key (stripe) in the meantime
+        self._cache_lock = Lock()
+        self._cache_epoch = 0
+        self._cache_generations = [0] * _CACHE_STRIPES
+        self._write_behind = None
+        if write_behind:
+            self._write_behind = WriteBehindBuffer(self, **(write_behind if isinstance(write_behind, dict) else {}))
+        # table -> {column: type}, and (table, column names) -> row decoder
+        self._schemas = {}
+        self._decoders = {}
+        self._init_connections()
+
+    def _init_connections(self):
+        self._pid = os.getpid()
+        self._local = local()
+        # Connections of dead threads are garbage-collected along with their thread-local storage
+        self._conns = weakref.WeakSet()
+        self._conns_lock = Lock()
+
+    def connection(self) -> sqlite3.Connection:
+        """Get the SQLite connection of the calling thread, opening it if needed"""
+
+        self._check_fork()
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.dbfile, **{"check_same_thread": False, **self.dbargs}, factory=_Connection)
+            conn.row_factory = sqlite3.Row
+            for pragma, value in self._pragmas.items():
+                conn.execute(f"PRAGMA {pragma}={value}")
+            try:
+                self._check_blob_format(conn)
+            except ValueError:
+                conn.close()
+                raise
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.add(conn)
+            _connections.add(conn)
+        return conn
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # Forked: forget the connections of the parent process (kept open in _inherited_connections)
+            self._init_connections()
+
+    def flush(self):
+        """Flush pending writes, when write_behind is enabled"""
+        if self._write_behind is not None:
+            self._write_behind.flush()
+
+    def close(self):
+        """Flush pending writes and close the connections of all threads. The state can still be used afterwards"""
+
+        self.flush()
+        self._check_fork()
+
+        with self._conns_lock:
+            conns = list(self._conns)
+            self._conns.clear()
+            self._local = local()
+
+        for conn in conns:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _schema(self, conn, table):
+        schema = self._schemas.get(table)
+        if schema is None:
+            schema = dict((col["name"], col["type"]) for col in conn.execute("PRAGMA table_info(%s)" % table))
+            if schema:
+                self._schemas[table] = schema
+        return schema
+
+    def _cache_generation(self, cache_key):
+        """Call before reading cache_key from the database, and pass the result to _cache_put()"""
+        return self._cache_epoch, self._cache_generations[hash(cache_key) % _CACHE_STRIPES]
+
+    def _cache_put(self, cache_key, value, generation):
+        with self._cache_lock:
+            if self._cache_generation(cache_key) == generation:
+                self.cache.put(cache_key, value)
+
+    def _cache_invalidate(self, cache_key, value=_MISSING):
+        """Call after a write to cache_key is committed, optionally caching its new value"""
+        with self._cache_lock:
+            self._cache_generations[hash(cache_key) % _CACHE_STRIPES] += 1
+            if value is _MISSING:
+                self.cache.pop(cache_key)
+            else:
+                self.cache.put(cache_key, value)
+
+    def _check_blob_format(self, conn):
+        """
+        Mark databases without any blob column as using native BLOBs, so that migrate_base64_blobs() leaves
+        them alone, and refuse to mix base64-encoded and native blobs in the same database
+        """
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= _NATIVE_BLOBS_VERSION:
+            if self.base64_blobs:
+                raise ValueError(f"{self.dbfile} uses native BLOBs, open it without base64_blobs=True")
+            return
+        if self.base64_blobs:
+            return
+
+        blob_columns = conn.execute(
+            "SELECT count(*) FROM sqlite_master m, pragma_table_info(m.name) c "
+            "WHERE m.type='table' AND m.name NOT LIKE 'sqlite_%' AND m.name != ? AND lower(c.type)='blob'",
+            (INDEX_CATALOG,)
+        ).fetchone()[0]
+        if blob_columns:
+            raise ValueError(
+                f"{self.dbfile} was written with base64-encoded blobs, open it with base64_blobs=True "
+                f"or convert it with migrate_base64_blobs()"
+            )
+        try:
+            conn.execute("PRAGMA user_version=%d" % _NATIVE_BLOBS_VERSION)
+        except sqlite3.OperationalError:
+            # Read-only connection, the database is stamped by the first writer
+            pass
+
+    def _invalidate_schema(self, table):
+        self._schemas.pop(table, None)
+        # list(): other threads add decoders concurrently
+        for k in [k for k in list(self._decoders) if k[0] == table]:
+            self._decoders.pop(k, None)
+
+    def _apply_indexes(self, conn, table):
+        """Create the missing indexes of the catalog for this table"""
+        try:
+            indexes = conn.execute(
+                "SELECT name, columns, is_unique FROM %s WHERE tbl=?" % INDEX_CATALOG, (table,)
+            ).fetchall()
+        except sqlite3.OperationalError:
+            return
+
+        for index in indexes:
+            try:
+                conn.execute("CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)" % (
+                    "UNIQUE " if index["is_unique"] else "", index["name"], table, index["columns"]
+                ))
+            except sqlite3.OperationalError:
+                # The table or some of the columns don't exist yet
+                pass
+
+    def _row_decoder(self, conn, table, description):
+        names = tuple(col[0] for col in description)
+
+        decoder = self._decoders.get((table, names))
+        if decoder is None:
+            schema = self._schema(conn, table)
+            if any(name not in schema for name in names):
+                self._invalidate_schema(table)
+                schema = self._schema(conn, table)
+
+            decoder = _make_row_decoder(names, schema, self._col_decoders)
+            self._decoders[(table, names)] = decoder
+        return decoder
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in ("_pid", "_local", "_conns", "_conns_lock", "_decoders", "_cache_lock"):
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._decoders = {}
+        self._cache_lock = Lock()
+        self._init_connections()
 
     def __getitem__(self, table):
         return self._table_factory(self, table)
 
+    def tables(self):
+        """Get the names of the tables in this database"""
+        return [
+            row["name"] for row in self.connection().execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' AND name != ?",
+                (INDEX_CATALOG,)
+            )
+        ]
+
+    def indexes(self, table):
+        """Get the (columns, unique) of the indexes created with Table.create_index()"""
+        try:
+            return [
+                (tuple(row["columns"].split(",")), bool(row["is_unique"])) for row in self.connection().execute(
+                    "SELECT columns, is_unique FROM %s WHERE tbl=?" % INDEX_CATALOG, (table,)
+                )
+            ]
+        except sqlite3.OperationalError:
+            return []
+
     def __delitem__(self, key):
-        with sqlite3.connect(self.dbfile, **self.dbargs) as conn:
+        self.flush()
+        conn = self.connection()
+        with conn:
             try:
                 conn.execute(f"DROP TABLE {key}")
             except:
                 pass
+        self._invalidate_schema(key)
+        if self.cache is not None:
+            with self._cache_lock:
+                self._cache_epoch += 1
+                self.cache.clear(lambda k: k[0] == key)
+
+
+class _FanOutError:
+    def __init__(self, error):
+        self.error = error
+
+
+_FAN_OUT_DONE = object()
+
+
+class ShardedTable:
+    def __init__(self, state, table):
+        self._state = state
+        self._table = table
+        self._tables = [shard[table] for shard in state.shards]
+
+    def _shard_table(self, key):
+        return self._tables[self._state.shard_index(key)]
+
+    def __getitem__(self, key):
+        return self._shard_table(key)[key]
+
+    def __setitem__(self, key, value):
+        self._shard_table(key)[key] = value
+
+    def __delitem__(self, key):
+        del self._shard_table(key)[key]
+
+    def set_many(self, items, batch_size=10000):
+        for batch in ichunks(items, batch_size):
+            by_shard = {}
+            for key, value in batch:
+                by_shard.setdefault(self._state.shard_index(key), []).append((key, value))
+            for i, shard_items in by_shard.items():
+                self._tables[i].set_many(shard_items, batch_size=batch_size)
+
+    def update(self, mapping, batch_size=10000):
+        self.set_many(mapping.items(), batch_size=batch_size)
+
+    def _fan_out(self, func):
+        """Yield from func(table) for the table of each shard, in parallel if the state has threads"""
+
+        executor = self._state._get_executor()
+        if executor is None:
+            for table in self._tables:
+                yield from func(table)
+            return
+
+        q = Queue(maxsize=1000)
+        stop = Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def produce(table):
+            try:
+                for item in func(table):
+                    if not put(item):
+                        return
+            except Exception as e:
+                put(_FanOutError(e))
+            put(_FAN_OUT_DONE)
+
+        for table in self._tables:
+            executor.submit(produce, table)
+
+        try:
+            done = 0
+            while done < len(self._tables):
+                item = q.get()
+                if item is _FAN_OUT_DONE:
+                    done += 1
+                elif isinstance(item, _FanOutError):
+                    raise item.error
+                else:
+                    yield item
+        finally:
+            # Unblock the producers if we stopped early
+            stop.set()
+
+    def __iter__(self):
+        return self._fan_out(iter)
+
+    def sql(self, where_clause, *params):
+        return self._fan_out(lambda t: t.sql(where_clause, *params))
+
+    def iter(self, columns=None, batch_size=1000, where=None, params=(), order_by="id"):
+        """Same as Table.iter(), rows are only ordered within each shard"""
+        return self._fan_out(lambda t: t.iter(columns, batch_size, where, params, order_by))
+
+    def keys(self, batch_size=10000):
+        return self._fan_out(lambda t: t.keys(batch_size))
+
+    def __len__(self):
+        return sum(self._fan_out(lambda t: (len(t),)))
+
+    def create_index(self, *columns, unique=False):
+        """Create an index in each shard (unique indexes are only unique within a shard)"""
+        for table in self._tables:
+            name = table.create_index(*columns, unique=unique)
+        return name
+
+    def drop_index(self, *columns):
+        for table in self._tables:
+            table.drop_index(*columns)
+
+    def explain(self, where_clause, *params):
+        return self._tables[0].explain(where_clause, *params)
+
+    def flush(self):
+        for table in self._tables:
+            table.flush()
+
+
+class ShardedPersistentState:
+    """
+    PersistentState split across several SQLite files (state.0.db, state.1.db, ... for dbfile="state.db").
+    Rows are routed to a shard by the strhash() of their key, scans and sql() queries go through all shards,
+    in parallel threads when threads > 1. Other arguments are passed to each PersistentState.
+
+    The number of shards of an existing database can be changed with reshard()
+    """
+
+    def __init__(self, dbfile="state.db", shards=4, threads=1, logger=None, table_factory=Table, **kwargs):
+        base, ext = os.path.splitext(dbfile)
+        self.dbfile = dbfile
+        self.logger = logger
+        self.shards = [
+            PersistentState(f"{base}.{i}{ext}", logger=logger, table_factory=table_factory, **kwargs)
+            for i in range(shards)
+        ]
+        self._threads = threads
+        self._executor = None
+        self._executor_lock = Lock()
+
+    def _get_executor(self):
+        """Thread pool of the parallel scans (None if threads <= 1), created again if the state was closed"""
+        if self._threads <= 1:
+            return None
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._threads)
+            return self._executor
+
+    def shard_index(self, key):
+        return strhash(str(key)) % len(self.shards)
+
+    def tables(self):
+        return sorted(set(table for shard in self.shards for table in shard.tables()))
+
+    def indexes(self, table):
+        return self.shards[0].indexes(table)
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_executor"]
+        del state["_executor_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._executor = None
+        self._executor_lock = Lock()
+
+    def __getitem__(self, table):
+        return ShardedTable(self, table)
+
+    def __delitem__(self, key):
+        for shard in self.shards:
+            del shard[key]
+
+
+def _raw_table_rows(state, table, batch_size):
+    """Iterate over the rows of a table as dicts (pydantic rows are not deserialized)"""
+    shards = state.shards if isinstance(state, ShardedPersistentState) else [state]
+    for shard in shards:
+        yield from shard[table]._raw_iter(batch_size=batch_size)
+
+
+def reshard(src, dst, batch_size=10000):
+    """
+    Copy all tables (and their indexes) from src to dst. Both can be either a PersistentState
+    or a ShardedPersistentState, for example to change the number of shards of a database
+    """
+
+    for table in src.tables():
+        if src.logger:
+            src.logger.info(f"Copying {table}")
+
+        for columns, unique in src.indexes(table):
+            dst[table].create_index(*columns, unique=unique)
+
+        dst[table].set_many(
+            ((row["id"], {k: v for k, v in row.items() if k != "id"}) for row in _raw_table_rows(src, table, batch_size)),
+            batch_size=batch_size
+        )
+
+    dst.flush()
+
+
+def _set_future(fut, result=None, error=None):
+    if fut.done():
+        return
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(result)
+
+
+class _AsyncWriter:
+    """Thread that applies queued writes, as many as possible in each transaction"""
+
+    def __init__(self, state, max_batch):
+        self._state = state
+        self._max_batch = max_batch
+        self._queue = Queue()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, op):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._queue.put((op, loop, fut))
+        return fut
+
+    def _apply(self, conn, op):
+        action, table, arg = op
+        t = self._state[table]
+        if action == _SET:
+            t._set_batch(conn, arg)
+        else:
+            t._delete_batch(conn, arg)
+
+    def _invalidate(self, op):
+        action, table, arg = op
+        t = self._state[table]
+        for key in (arg if action == _DELETE else (k for k, _ in arg)):
+            t._invalidate(key)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            while len(batch) < self._max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+
+            if None in batch:
+                stop = True
+                batch = batch[:batch.index(None)]
+            if not batch:
+                continue
+
+            conn = self._state.connection()
+            try:
+                with conn:
+                    for op, _, _ in batch:
+                        self._apply(conn, op)
+                results = [(loop, fut, None) for op, loop, fut in batch]
+            except Exception:
+                # Find out which writes failed by retrying them one by one
+                results = []
+                for op, loop, fut in batch:
+                    try:
+                        with conn:
+                            self._apply(conn, op)
+                        results.append((loop, fut, None))
+                    except Exception as e:
+                        results.append((loop, fut, e))
+
+            for op, _, _ in batch:
+                self._invalidate(op)
+            for loop, fut, error in results:
+                loop.call_soon_threadsafe(_set_future, fut, None, error)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+class AsyncTable:
+    def __init__(self, state, table):
+        self._state = state
+        self._table = table
+        self._sync_table = state.state[table]
+
+    async def _read(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._state._readers, func, *args)
+
+    async def get(self, key):
+        return await self._read(self._sync_table.__getitem__, key)
+
+    async def set(self, key, value):
+        await self._state._writer.submit((_SET, self._table, [(key, value)]))
+
+    async def set_many(self, items):
+        await self._state._writer.submit((_SET, self._table, list(items)))
+
+    async def delete(self, key):
+        await self._state._writer.submit((_DELETE, self._table, [key]))
+
+    async def sql(self, where_clause, *params):
+        return await self._read(lambda: list(self._sync_table.sql(where_clause, *params)))
+
+    async def count(self):
+        return await self._read(self._sync_table.__len__)
+
+    async def iter(self, columns=None, batch_size=1000, where=None, params=(), order_by="id"):
+        """Same as Table.iter(), each batch is fetched from a reader thread"""
+        it = self._sync_table.iter(columns, batch_size, where, params, order_by)
+        while True:
+            rows = await self._read(lambda: list(itertools.islice(it, batch_size)))
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                return
+
+    def __aiter__(self):
+        return self.iter()
+
+
+class AsyncPersistentState:
+    """
+    asyncio interface for PersistentState. Reads are done in a pool of reader threads (one connection each),
+    writes are sent to a dedicated writer thread, which groups concurrent writes into a single transaction.
+    Other arguments are passed to PersistentState (available as self.state)
+    """
+
+    def __init__(self, dbfile="state.db", readers=4, max_batch=1000, **kwargs):
+        self.state = PersistentState(dbfile, **kwargs)
+        self._readers = ThreadPoolExecutor(max_workers=readers)
+        self._writer = _AsyncWriter(self.state, max_batch)
+
+    def __getitem__(self, table):
+        return AsyncTable(self, table)
+
+    async def close(self):
+        """Wait for pending writes and close all connections"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._writer.close)
+        self._readers.shutdown(wait=True)
+        self.state.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+def migrate_base64_blobs(dbfile="state.db", logger=None, **dbargs):
+    """
+    Convert a database written with base64-encoded blobs to native BLOBs, in a single transaction.
+    Databases marked as migrated (user_version), or created with native BLOBs by PersistentState,
+    are left untouched
+    """
+
+    if not dbargs:
+        dbargs = {"timeout": 30000}
+
+    conn = sqlite3.connect(dbfile, **dbargs)
+    conn.row_factory = sqlite3.Row
+    conn.create_function("hexlib_b64decode", 1, base64.b64decode, deterministic=True)
+
+    try:
+        with conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= _NATIVE_BLOBS_VERSION:
+                if logger:
+                    logger.warning(f"{dbfile} already uses native BLOBs, not migrating")
+                return
+
+            tables = [
+                row["name"] for row in
+                conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")
+            ]
+            for table in tables:
+                for col in conn.execute("PRAGMA table_info(%s)" % table).fetchall():
+                    if col["type"].lower() != "blob":
+                        continue
+                    if logger:
+                        logger.info(f"Migrating {table}.{col['name']}")
+                    conn.execute(
+                        "UPDATE %s SET %s=hexlib_b64decode(%s) WHERE %s IS NOT NULL" %
+                        (table, col["name"], col["name"], col["name"])
+                    )
+            conn.execute("PRAGMA user_version=%d" % _NATIVE_BLOBS_VERSION)
+    finally:
+        conn.close()
 
 
 def pg_fetch_cursor_all(cur, name, batch_size=1000):
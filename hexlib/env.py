@@ -1,4 +1,5 @@
 import os
+from threading import Lock
 
 import redis
 from fake_useragent import UserAgent
@@ -10,11 +11,70 @@ ARC_LISTS = os.environ.get("ARC_LISTS", "arc").split(",")
 PUBLISH_CHANNEL = os.environ.get("PUBLISH_CHANNEL", None)
 
 
-def get_redis():
-    return redis.Redis(
-        host=os.environ.get("REDIS_HOST", "localhost"),
-        port=int(os.environ.get("REDIS_PORT", 6379))
-    )
+_redis_pools = {}
+_redis_pools_lock = Lock()
+_redis_pools_pid = os.getpid()
+
+
+def _redis_pool_kwargs():
+    kwargs = {
+        "socket_keepalive": os.environ.get("REDIS_KEEPALIVE", "0").lower() in ("1", "true", "yes"),
+        "health_check_interval": int(os.environ.get("REDIS_HEALTH_CHECK_INTERVAL", 0)),
+    }
+    if os.environ.get("REDIS_MAX_CONNECTIONS"):
+        kwargs["max_connections"] = int(os.environ["REDIS_MAX_CONNECTIONS"])
+    return kwargs
+
+
+def get_redis_pool(host=None, port=None, db=None, unix_socket_path=None):
+    """
+    Process-wide connection pool for host/port/db (or unix_socket_path/db), created on first use.
+    Defaults and pool options are read from the environment:
+
+    REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_SOCKET (unix socket path, takes precedence over host/port),
+    REDIS_MAX_CONNECTIONS (callers wait for a free connection once reached), REDIS_KEEPALIVE,
+    REDIS_HEALTH_CHECK_INTERVAL (seconds)
+
+    Pools are not shared with forked child processes
+    """
+    global _redis_pools_pid
+
+    if unix_socket_path is None and host is None:
+        unix_socket_path = os.environ.get("REDIS_SOCKET") or None
+    if db is None:
+        db = int(os.environ.get("REDIS_DB", 0))
+
+    if unix_socket_path:
+        key = (unix_socket_path, None, db)
+    else:
+        key = (
+            host or os.environ.get("REDIS_HOST", "localhost"),
+            int(port or os.environ.get("REDIS_PORT", 6379)),
+            db
+        )
+
+    with _redis_pools_lock:
+        if _redis_pools_pid != os.getpid():
+            _redis_pools.clear()
+            _redis_pools_pid = os.getpid()
+
+        pool = _redis_pools.get(key)
+        if pool is None:
+            kwargs = _redis_pool_kwargs()
+            pool_class = redis.BlockingConnectionPool if "max_connections" in kwargs else redis.ConnectionPool
+            if unix_socket_path:
+                kwargs.pop("socket_keepalive")
+                pool = pool_class(connection_class=redis.UnixDomainSocketConnection, path=unix_socket_path, db=db,
+                                  **kwargs)
+            else:
+                pool = pool_class(host=key[0], port=key[1], db=db, **kwargs)
+            _redis_pools[key] = pool
+        return pool
+
+
+def get_redis(host=None, port=None, db=None, unix_socket_path=None):
+    """Redis client using the shared connection pool, see get_redis_pool()"""
+    return redis.Redis(connection_pool=get_redis_pool(host, port, db, unix_socket_path))
 
 
 def redis_publish(rdb, item, item_project, item_type, item_subproject=None, item_category="x"):
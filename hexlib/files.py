@@ -72,6 +72,42 @@ class NDJsonLine:
         return json.loads(self.text)
 
 
+class NDJsonWriter:
+    """Streaming NDJSON writer, optionally compressed with gzip or (multi-threaded) zstd"""
+
+    def __init__(self, file, compression="", level=3, threads=0, default=None):
+        self._file = file
+        self._compression = compression
+        self._level = level
+        self._threads = threads
+        self._default = default
+        self._fp = None
+        self._writer = None
+
+    def __enter__(self):
+        if self._compression == COMPRESSION_GZIP:
+            self._writer = gzip.open(self._file, "wb", compresslevel=self._level)
+        elif self._compression == COMPRESSION_ZSTD:
+            self._fp = open(self._file, "wb")
+            cctx = zstandard.ZstdCompressor(level=self._level, threads=self._threads)
+            self._writer = cctx.stream_writer(self._fp)
+        else:
+            self._writer = open(self._file, "wb")
+        return self
+
+    def write(self, obj):
+        line = json.dumps(obj, default=self._default)
+        if isinstance(line, str):
+            line = line.encode()
+        self._writer.write(line)
+        self._writer.write(b"\n")
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._writer.close()
+        if self._fp:
+            self._fp.close()
+
+
 def ndjson_iter(*files, compression=""):
     for file in files:
         cleanup = None
@@ -3,6 +3,7 @@ import itertools
 import os
 import sys
 import time
+from collections import OrderedDict
 from threading import Lock
 from time import sleep
 
@@ -90,6 +91,72 @@ def buffered(batch_size: int, flush_on_exit: bool = False):
     return decorate
 
 
+class LRUCache:
+    """Thread-safe bounded LRU cache, with optional TTL (in seconds) and hit/miss/eviction counters"""
+
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self, predicate=None):
+        """Remove all entries, or only the ones whose key matches predicate"""
+        with self._lock:
+            if predicate is None:
+                self._data.clear()
+            else:
+                for key in [k for k in self._data if predicate(k)]:
+                    del self._data[key]
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getstate__(self):
+        # Entries are not copied: expiry times are only meaningful in this process
+        return {"max_size": self.max_size, "ttl": self.ttl}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
 Key = b"0123456789ABCDEF"
 
 
@@ -2,11 +2,13 @@ import json
 from collections import namedtuple
 from functools import partial
 from itertools import islice
-from time import sleep, time
+from time import monotonic, sleep, time
 
 from orjson import orjson
 from redis import Redis
 
+from hexlib.serializers import allowed_ids, get_serializer, loads
+
 RoutingKeyParts = namedtuple(
     "RoutingKeyParts",
     ["arc_list", "project", "subproject", "type", "category"]
@@ -44,20 +46,85 @@ class MessageQueue:
         raise NotImplementedError()
 
 
+# Pop up to ARGV[1] items from KEYS, in order (LPOP with count requires Redis >= 6.2).
+# Returns a flat list of key, item, key, item, ...
+_POP_MANY_SCRIPT = """
+local remaining = tonumber(ARGV[1])
+local result = {}
+for _, key in ipairs(KEYS) do
+    if remaining <= 0 then
+        break
+    end
+    local items = redis.call('LPOP', key, remaining)
+    if items then
+        for _, item in ipairs(items) do
+            table.insert(result, key)
+            table.insert(result, item)
+        end
+        remaining = remaining - #items
+    end
+end
+return result
+"""
+
+# Claim up to ARGV[3] pending tasks whose deadline (KEYS[2]) is <= ARGV[1]: their deadline is
+# moved to ARGV[2] so that they are not redelivered again before then.
+# Returns a flat list of task_id, payload, task_id, payload, ...
+_CLAIM_PENDING_SCRIPT = """
+local task_ids = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+local result = {}
+for _, task_id in ipairs(task_ids) do
+    local payload = redis.call('HGET', KEYS[1], task_id)
+    if payload then
+        redis.call('ZADD', KEYS[2], ARGV[2], task_id)
+        table.insert(result, task_id)
+        table.insert(result, payload)
+    else
+        redis.call('ZREM', KEYS[2], task_id)
+    end
+end
+return result
+"""
+
+# Remove task ids (ARGV) from the pending hash (KEYS[1]) and deadlines (KEYS[2])
+_ACK_SCRIPT = """
+for _, task_id in ipairs(ARGV) do
+    redis.call('HDEL', KEYS[1], task_id)
+    redis.call('ZREM', KEYS[2], task_id)
+end
+return #ARGV
+"""
+
+
 class RedisMQ(MessageQueue):
     _MAX_KEYS = 30
 
     def __init__(self, rdb, consumer_name="redis_mq", sep=".", max_pending_time=120, logger=None, publish_channel=None,
-                 arc_lists=None, wait=1):
+                 arc_lists=None, wait=1, serializer=None, pending_check_interval=1):
+        """
+        serializer: name or instance from hexlib.serializers used to publish messages (default: JSON text),
+        messages published with any serializer can be read, except pickle unless serializer is a pickle serializer
+
+        Pending tasks are stored in a hash (pending{sep}consumer_name) and their redelivery deadlines
+        in a sorted set (pending{sep}consumer_name{sep}deadlines), checked every pending_check_interval seconds
+        """
         self._rdb: Redis = rdb
         self._key_cache = None
         self._consumer_id = consumer_name
         self._pending_list = f"pending{sep}{consumer_name}"
+        self._pending_deadlines = f"{self._pending_list}{sep}deadlines"
+        self._dead_letter_list = f"dead{sep}{consumer_name}"
+        self._pending_check_interval = pending_check_interval
         self._max_pending_time = max_pending_time
         self._logger = logger
         self._publish_channel = publish_channel
         self._arc_lists = arc_lists
         self._wait = wait
+        self._serializer = get_serializer(serializer)
+        self._allowed = allowed_ids(self._serializer)
+        self._pop_many = rdb.register_script(_POP_MANY_SCRIPT)
+        self._claim_pending = rdb.register_script(_CLAIM_PENDING_SCRIPT)
+        self._ack_script = rdb.register_script(_ACK_SCRIPT)
 
     def _get_keys(self, pattern):
         if self._key_cache:
@@ -70,16 +137,82 @@ class RedisMQ(MessageQueue):
 
         return keys
 
-    def _get_pending_tasks(self):
+    def _dumps_pending(self, obj):
+        if self._serializer is not None:
+            return self._serializer.dumps(obj)
+        return orjson.dumps(obj)
+
+    def _migrate_pending(self):
+        """Add deadlines for pending tasks written by older versions (in the hash only)"""
+        if self._rdb.hlen(self._pending_list) <= self._rdb.zcard(self._pending_deadlines):
+            return
+
+        pipe = self._rdb.pipeline(transaction=False)
         for task_id, pending_task in self._rdb.hscan_iter(self._pending_list):
+            resubmit_at = loads(pending_task, fallback=orjson.loads, allowed=self._allowed).get("resubmit_at", 0)
+            pipe.zadd(self._pending_deadlines, {task_id: resubmit_at}, nx=True)
+        pipe.execute()
 
-            pending_task_json = orjson.loads(pending_task)
+    def _pending_payload(self, topic, task_json, resubmit_at):
+        # resubmit_at is only read by older versions, the deadlines sorted set is authoritative
+        return self._dumps_pending({"resubmit_at": resubmit_at, "topic": topic, "task": task_json})
 
-            if time() >= pending_task_json["resubmit_at"]:
-                yield pending_task_json["topic"], pending_task_json["task"], partial(self._ack, task_id)
+    def _add_pending(self, payloads, resubmit_at, dead_letters=()):
+        """
+        Add task_id -> pending payload to the pending hash and deadlines, and raw tasks that
+        could not be decoded to the dead letter list, in one transaction
+        """
+        pipe = self._rdb.pipeline(transaction=True)
+        if payloads:
+            pipe.hset(self._pending_list, mapping=payloads)
+            pipe.zadd(self._pending_deadlines, {task_id: resubmit_at for task_id in payloads})
+        if dead_letters:
+            pipe.rpush(self._dead_letter_list, *dead_letters)
+        pipe.execute()
+
+    def _expired_pending_tasks(self, limit=1000):
+        """Claims expired pending tasks, limit at a time"""
+        while True:
+            now = time()
+            result = self._claim_pending(
+                keys=[self._pending_list, self._pending_deadlines],
+                args=[now, now + self._max_pending_time, limit]
+            )
+            for task_id, pending_task in zip(result[::2], result[1::2]):
+                pending_task_json = loads(pending_task, fallback=orjson.loads, allowed=self._allowed)
+                yield task_id, pending_task_json["topic"], pending_task_json["task"]
+
+            if len(result) < limit * 2:
+                break
+
+    def _get_pending_tasks(self):
+        for task_id, topic, task in self._expired_pending_tasks():
+            yield topic, task, partial(self._ack, task_id)
 
     def _ack(self, task_id):
-        self._rdb.hdel(self._pending_list, task_id)
+        self._ack_script(keys=[self._pending_list, self._pending_deadlines], args=[task_id])
+
+    def _ack_all(self, task_ids):
+        if task_ids:
+            self._ack_script(keys=[self._pending_list, self._pending_deadlines], args=task_ids)
+
+    def _decode_task(self, topic, task):
+        task_json = loads(task, fallback=orjson.loads, allowed=self._allowed)
+
+        if "_id" not in task_json or not task_json["_id"]:
+            raise ValueError(f"Task doesn't have _id field: {task}")
+
+        return topic.decode(), task_json
+
+    def _pending_batches(self, batch_size):
+        pending = self._expired_pending_tasks(limit=batch_size)
+        while True:
+            batch = list(islice(pending, batch_size))
+            if not batch:
+                break
+            yield [
+                (topic, task, partial(self._ack, task_id)) for task_id, topic, task in batch
+            ], partial(self._ack_all, [task_id for task_id, _, _ in batch])
 
     def read_messages(self, topics):
         """
@@ -87,22 +220,23 @@ class RedisMQ(MessageQueue):
 
         Tasks are automatically put into a pending list until ack() is called.
         When a task has been in the pending list for at least max_pending_time seconds, it
-        gets submitted again
+        gets submitted again (at most once every max_pending_time seconds)
         """
 
         assert len(topics) == 1, "RedisMQ only supports 1 topic pattern"
 
         pattern = topics[0]
-        counter = 0
+        next_pending_check = 0
 
         if self._logger:
             self._logger.info(f"MQ>Listening for new messages in {pattern}")
 
-        while True:
-            counter += 1
+        self._migrate_pending()
 
-            if counter % 1000 == 0:
+        while True:
+            if monotonic() >= next_pending_check:
                 yield from self._get_pending_tasks()
+                next_pending_check = monotonic() + self._pending_check_interval
 
             keys = self._get_keys(pattern)
             if not keys:
@@ -115,32 +249,95 @@ class RedisMQ(MessageQueue):
                 self._key_cache = None
                 continue
 
-            topic, task = result
+            topic, task_json = self._decode_task(*result)
+
+            # Immediately put in pending queue
+            resubmit_at = time() + self._max_pending_time
+            self._add_pending({task_json["_id"]: self._pending_payload(topic, task_json, resubmit_at)}, resubmit_at)
+
+            yield topic, task_json, partial(self._ack, task_json["_id"])
 
-            task_json = orjson.loads(task)
-            topic = topic.decode()
+    def read_batches(self, topics, batch_size=100, max_wait=1):
+        """
+        Batched version of read_messages(), yields (messages, ack_all) where messages is a list of
+        up to batch_size (topic, task, ack) tuples and ack_all() acknowledges the whole batch.
+
+        Each batch is popped with a single script call (requires Redis >= 6.2) and added to the pending
+        list in one round trip. Batches are yielded as soon as messages are available, when all lists are
+        empty, waits up to max_wait seconds for a new message.
+
+        Tasks that cannot be decoded or have no _id are moved to the dead{sep}consumer_name list
+        """
+
+        assert len(topics) == 1, "RedisMQ only supports 1 topic pattern"
+
+        pattern = topics[0]
+        next_pending_check = 0
+
+        if self._logger:
+            self._logger.info(f"MQ>Listening for new message batches in {pattern}")
 
-            if "_id" not in task_json or not task_json["_id"]:
-                raise ValueError(f"Task doesn't have _id field: {task}")
+        self._migrate_pending()
+
+        while True:
+            if monotonic() >= next_pending_check:
+                yield from self._pending_batches(batch_size)
+                next_pending_check = monotonic() + self._pending_check_interval
+
+            keys = self._get_keys(pattern)
+            if not keys:
+                sleep(self._wait)
+                self._key_cache = None
+                continue
+
+            result = self._pop_many(keys=keys, args=[batch_size])
+            popped = list(zip(result[::2], result[1::2]))
+
+            if not popped:
+                result = self._rdb.blpop(keys, timeout=max_wait)
+                if not result:
+                    self._key_cache = None
+                    continue
+                popped = [result]
+                if batch_size > 1:
+                    result = self._pop_many(keys=keys, args=[batch_size - 1])
+                    popped.extend(zip(result[::2], result[1::2]))
+
+            messages = []
+            payloads = {}
+            dead_letters = []
+            resubmit_at = time() + self._max_pending_time
+            for topic, task in popped:
+                try:
+                    topic, task_json = self._decode_task(topic, task)
+                    payloads[task_json["_id"]] = self._pending_payload(topic, task_json, resubmit_at)
+                    messages.append((topic, task_json))
+                except Exception as e:
+                    # Don't lose the rest of the batch
+                    if self._logger:
+                        self._logger.error(f"MQ>Moving invalid task to {self._dead_letter_list}: {e}")
+                    dead_letters.append(task)
 
             # Immediately put in pending queue
-            self._rdb.hset(
-                self._pending_list, task_json["_id"],
-                orjson.dumps({
-                    "resubmit_at": time() + self._max_pending_time,
-                    "topic": topic,
-                    "task": task_json
-                })
-            )
+            self._add_pending(payloads, resubmit_at, dead_letters)
+            if not messages:
+                continue
 
-            yield topic, task_json, partial(self._ack, task_json["_id"])
+            task_ids = [task_json["_id"] for _, task_json in messages]
+            yield [
+                (topic, task_json, partial(self._ack, task_json["_id"]))
+                for topic, task_json in messages
+            ], partial(self._ack_all, task_ids)
 
     def publish(self, item, item_project, item_type, item_subproject=None, item_category="x"):
 
         if "_id" not in item:
             raise ValueError("_id field must be set for item")
 
-        item = json.dumps(item, separators=(',', ':'), ensure_ascii=False, sort_keys=True)
+        if self._serializer is None:
+            item = json.dumps(item, separators=(',', ':'), ensure_ascii=False, sort_keys=True)
+        else:
+            item = self._serializer.dumps(item)
 
         item_project = item_project.replace(".", "-")
         item_subproject = item_subproject.replace(".", "-") if item_subproject else None
@@ -0,0 +1,93 @@
+import pickle
+
+import orjson
+import umsgpack
+import zstandard
+
+# 0xc1 is never used by msgpack and cannot start UTF-8 (JSON) text, so tagged values
+# can be told apart from the untagged umsgpack/JSON values written by older versions
+TAG = b"\xc1"
+_COMPRESSED = 0x80
+
+
+class Serializer:
+    """
+    Encodes values as TAG, one byte id, payload (decoded by loads()). Values of at least compress_min_size
+    bytes are compressed with zstd if compress is set (flagged in the id byte)
+    """
+
+    def __init__(self, name, id, dumps, compress=False, compress_min_size=1024, level=3):
+        self.name = name
+        self.id = id
+        self._dumps = dumps
+        self._compress = compress
+        self._compress_min_size = compress_min_size
+        self._level = level
+
+    def dumps(self, obj):
+        data = self._dumps(obj)
+        if self._compress and len(data) >= self._compress_min_size:
+            return TAG + bytes((self.id | _COMPRESSED,)) + zstandard.compress(data, self._level)
+        return TAG + bytes((self.id,)) + data
+
+    def __repr__(self):
+        return f"Serializer({self.name})"
+
+
+def _pickle_dumps(obj):
+    return pickle.dumps(obj, protocol=5)
+
+
+_BY_ID = {
+    1: umsgpack.loads,
+    2: orjson.loads,
+    # Unpickling can execute arbitrary code: only decoded by instances configured with a pickle serializer
+    3: pickle.loads,
+}
+
+SAFE_IDS = frozenset((1, 2))
+
+SERIALIZERS = {
+    "umsgpack": Serializer("umsgpack", 1, umsgpack.dumps),
+    "orjson": Serializer("orjson", 2, orjson.dumps),
+    "pickle": Serializer("pickle", 3, _pickle_dumps),
+    "umsgpack+zstd": Serializer("umsgpack+zstd", 1, umsgpack.dumps, compress=True),
+    "orjson+zstd": Serializer("orjson+zstd", 2, orjson.dumps, compress=True),
+    "pickle+zstd": Serializer("pickle+zstd", 3, _pickle_dumps, compress=True),
+}
+
+
+def get_serializer(serializer):
+    """Serializer instance, name (see SERIALIZERS) or None"""
+    if serializer is None or isinstance(serializer, Serializer):
+        return serializer
+    if serializer not in SERIALIZERS:
+        raise ValueError(f"Unknown serializer: {serializer}")
+    return SERIALIZERS[serializer]
+
+
+def allowed_ids(serializer):
+    """Serializer ids that can be decoded by an instance writing with serializer (pickle only if it is pickle)"""
+    if serializer is None:
+        return SAFE_IDS
+    return SAFE_IDS | {serializer.id}
+
+
+def loads(data, fallback=umsgpack.loads, allowed=SAFE_IDS):
+    """
+    Decode a value written by any serializer whose id is in allowed.
+    Untagged values are decoded with fallback
+    """
+    if data[:1] != TAG:
+        return fallback(data)
+
+    id = data[1] & ~_COMPRESSED
+    if id not in _BY_ID:
+        raise ValueError(f"Unknown serializer id: {id}")
+    if id not in allowed:
+        raise ValueError(f"Serializer id {id} is not allowed")
+
+    payload = data[2:]
+    if data[1] & _COMPRESSED:
+        payload = zstandard.decompress(payload)
+    return _BY_ID[id](payload)
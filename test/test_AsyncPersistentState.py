@@ -0,0 +1,59 @@
+import asyncio
+import os
+from unittest import IsolatedAsyncioTestCase
+
+from hexlib.db import AsyncPersistentState, PersistentState
+
+
+class TestAsyncPersistentState(IsolatedAsyncioTestCase):
+
+    def tearDown(self) -> None:
+        for file in ("state.db", "state.db-wal", "state.db-shm"):
+            if os.path.exists(file):
+                os.remove(file)
+
+    def setUp(self) -> None:
+        self.tearDown()
+
+    async def test_get_set(self):
+        async with AsyncPersistentState() as s:
+            await s["a"].set(1, {"x": 1, "y": b'abc'})
+
+            self.assertDictEqual(await s["a"].get(1), {"id": 1, "x": 1, "y": b'abc'})
+            self.assertIsNone(await s["a"].get(2))
+
+            await s["a"].delete(1)
+            self.assertIsNone(await s["a"].get(1))
+
+    async def test_concurrent_writes(self):
+        async with AsyncPersistentState(profile="fast") as s:
+            await asyncio.gather(*(s["a"].set(i, {"x": i}) for i in range(200)))
+
+            self.assertEqual(await s["a"].count(), 200)
+            self.assertEqual(len(await s["a"].sql("WHERE x < 10")), 10)
+
+        self.assertEqual(len(PersistentState()["a"]), 200)
+
+    async def test_write_error(self):
+        async with AsyncPersistentState() as s:
+            await s["a"].set(1, {"x": 1})
+
+            results = await asyncio.gather(
+                s["a"].set(2, {"x": 2}),
+                s["a"].set("not an int", {"x": 3}),
+                return_exceptions=True
+            )
+
+            self.assertIsNone(results[0])
+            self.assertIsInstance(results[1], Exception)
+            self.assertEqual((await s["a"].get(2))["x"], 2)
+
+    async def test_iter(self):
+        async with AsyncPersistentState() as s:
+            await s["a"].set_many((i, {"x": i}) for i in range(25))
+
+            ids = [row["id"] async for row in s["a"]]
+            self.assertEqual(ids, list(range(25)))
+
+            rows = [row async for row in s["a"].iter(columns=["id"], batch_size=10, where="x >= ?", params=(20,))]
+            self.assertEqual(rows, [{"id": i} for i in range(20, 25)])
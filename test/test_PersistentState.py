@@ -1,18 +1,42 @@
+import gc
 import os
+import pickle
+import sqlite3
+import weakref
+from datetime import datetime
+from multiprocessing import get_context
+from threading import Thread
+from time import sleep
 from unittest import TestCase
 
-from hexlib.db import PersistentState
+import numpy as np
+
+from hexlib.db import PersistentState, migrate_base64_blobs
+
+
+def _child_setitem(s, key):
+    s["a"][key] = {"x": key}
+
+
+def _child_parent_conn_alive(s, conn):
+    s["a"][1] = {"x": 1}
+    s.close()
+    gc.collect()
+    if conn() is None:
+        raise SystemExit(1)
 
 
 class TestPersistentState(TestCase):
 
     def tearDown(self) -> None:
-        if os.path.exists("state.db"):
-            os.remove("state.db")
+        for file in ("state.db", "state.db-wal", "state.db-shm"):
+            if os.path.exists(file):
+                os.remove(file)
 
     def setUp(self) -> None:
-        if os.path.exists("state.db"):
-            os.remove("state.db")
+        for file in ("state.db", "state.db-wal", "state.db-shm"):
+            if os.path.exists(file):
+                os.remove(file)
 
     def test_get_set(self):
         s = PersistentState()
@@ -141,3 +165,517 @@ class TestPersistentState(TestCase):
 
         del s["a"]
         self.assertEqual(len(list(s["a"])), 0)
+
+    def test_connection_reuse(self):
+        s = PersistentState()
+
+        s["a"][0] = {"x": 1}
+        conn = s.connection()
+        s["a"][1] = {"x": 2}
+
+        self.assertIs(conn, s.connection())
+        self.assertEqual(len(list(s["a"])), 2)
+
+    def test_connection_per_thread(self):
+        s = PersistentState()
+        conns = [None] * 4
+
+        def worker(i):
+            conns[i] = s.connection()
+            s["a"][i + 1] = {"x": 1}
+
+        threads = [Thread(target=worker, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(set(id(c) for c in conns)), 4)
+        self.assertEqual(len(list(s["a"])), 4)
+
+    def test_invalidate_schema_concurrent(self):
+        s = PersistentState()
+        s["a"][1] = {"x": 1, "y": 2, "z": 3}
+        errors = []
+
+        def reader():
+            try:
+                for i in range(2000):
+                    for columns in (("x",), ("y",), ("z",), ("x", "y"), ("y", "z")):
+                        s._row_decoder(s.connection(), "a", [(name,) for name in ("id", *columns)])
+            except Exception as e:
+                errors.append(e)
+
+        def invalidate():
+            try:
+                for i in range(20000):
+                    s._invalidate_schema("a")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=reader), Thread(target=invalidate)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+
+    def test_close(self):
+        s = PersistentState()
+
+        s["a"][0] = {"x": 1}
+        conn = s.connection()
+        s.close()
+
+        self.assertIsNot(conn, s.connection())
+        self.assertEqual(s["a"][0]["x"], 1)
+
+    def test_context_manager(self):
+        with PersistentState() as s:
+            s["a"][0] = {"x": 1}
+            conn = s.connection()
+
+        with self.assertRaises(Exception):
+            conn.execute("SELECT 1")
+
+    def test_fork(self):
+        s = PersistentState()
+        s["a"][0] = {"x": 0}
+
+        for i, method in enumerate(("fork", "spawn"), start=1):
+            p = get_context(method).Process(target=_child_setitem, args=(s, i))
+            p.start()
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+
+        self.assertEqual(s["a"][1]["x"], 1)
+        self.assertEqual(s["a"][2]["x"], 2)
+
+    def test_fork_parent_connection(self):
+        s = PersistentState()
+        s["a"][0] = {"x": 0}
+        conn = weakref.ref(s.connection())
+
+        p = get_context("fork").Process(target=_child_parent_conn_alive, args=(s, conn))
+        p.start()
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+        self.assertEqual(s["a"][1]["x"], 1)
+
+    def test_set_many(self):
+        s = PersistentState()
+
+        s["a"].set_many(((i, {"x": i, "y": b'abc'}) for i in range(100)), batch_size=30)
+
+        self.assertEqual(len(list(s["a"])), 100)
+        self.assertDictEqual(s["a"][42], {"id": 42, "x": 42, "y": b'abc'})
+
+    def test_set_many_update_partial(self):
+        s = PersistentState()
+
+        s["a"][1] = {"x": 1, "y": "a"}
+        s["a"].update({1: {"x": 2}, 2: {"x": 3, "z": 4.4}})
+
+        self.assertDictEqual(s["a"][1], {"id": 1, "x": 2, "y": "a", "z": None})
+        self.assertDictEqual(s["a"][2], {"id": 2, "x": 3, "y": None, "z": 4.4})
+
+    def test_deserialize_none_blob(self):
+        s = PersistentState()
+
+        s["a"][0] = {"x": b'abc'}
+        s["a"][1] = {"x": None}
+
+        self.assertIsNone(s["a"][1]["x"])
+
+    def test_schema_altered_by_other_state(self):
+        s1 = PersistentState()
+        s2 = PersistentState()
+
+        s1["a"][0] = {"x": 1}
+        self.assertDictEqual(s1["a"][0], {"id": 0, "x": 1})
+
+        s2["a"].set_many([(1, {"x": 2, "y": b'abc'})])
+
+        self.assertDictEqual(s1["a"][1], {"id": 1, "x": 2, "y": b'abc'})
+        self.assertDictEqual(s1["a"][0], {"id": 0, "x": 1, "y": None})
+
+    def test_schema_drop_table(self):
+        s = PersistentState()
+
+        s["a"][0] = {"x": b'abc'}
+        self.assertEqual(s["a"][0]["x"], b'abc')
+
+        del s["a"]
+        s["a"][0] = {"x": "abc"}
+
+        self.assertEqual(s["a"][0]["x"], "abc")
+
+    def test_native_blob(self):
+        s = PersistentState()
+
+        s["a"][0] = {"x": b'abc'}
+
+        raw = s.connection().execute("SELECT x FROM a WHERE id=0").fetchone()[0]
+        self.assertEqual(raw, b'abc')
+
+    def test_base64_blobs(self):
+        s = PersistentState(base64_blobs=True)
+
+        s["a"][0] = {"x": b'abc'}
+
+        raw = s.connection().execute("SELECT x FROM a WHERE id=0").fetchone()[0]
+        self.assertEqual(raw, b'YWJj')
+        self.assertEqual(s["a"][0]["x"], b'abc')
+
+    def test_migrate_base64_blobs(self):
+        s = PersistentState(base64_blobs=True)
+        s["a"][0] = {"x": b'abc', "y": "abc"}
+        s["a"][1] = {"x": None, "y": "abc"}
+        s.close()
+
+        migrate_base64_blobs()
+        migrate_base64_blobs()
+
+        s = PersistentState()
+        self.assertDictEqual(s["a"][0], {"id": 0, "x": b'abc', "y": "abc"})
+        self.assertDictEqual(s["a"][1], {"id": 1, "x": None, "y": "abc"})
+
+    def test_set_many_order(self):
+        s = PersistentState()
+
+        s["a"].set_many([(1, {"x": 1, "y": 1}), (1, {"x": 2}), (1, {"x": 3, "y": 3}), (2, {"y": 1, "x": 2})])
+
+        self.assertEqual(s["a"][1], {"id": 1, "x": 3, "y": 3})
+        self.assertEqual(s["a"][2], {"id": 2, "x": 2, "y": 1})
+
+    def test_table_dropped_by_other_instance(self):
+        s1 = PersistentState()
+        s2 = PersistentState()
+
+        s1["a"][0] = {"x": 1}
+        s1["a"].set_many([(1, {"x": 1})])
+        del s2["a"]
+
+        s1["a"][0] = {"x": 2}
+        del s2["a"]
+        s1["a"].set_many([(1, {"x": 3})])
+
+        self.assertEqual(list(s2["a"]), [{"id": 1, "x": 3}])
+
+    def test_migrate_native_blobs(self):
+        s = PersistentState()
+        s["a"][0] = {"x": b"abcd"}
+        s.close()
+
+        migrate_base64_blobs()
+
+        s = PersistentState()
+        self.assertEqual(s["a"][0]["x"], b"abcd")
+
+    def test_migrate_native_blobs_index_first(self):
+        s = PersistentState()
+        s["a"].create_index("y")
+        s["a"][0] = {"x": b"abcd", "y": 1}
+        s.close()
+
+        migrate_base64_blobs()
+
+        s = PersistentState()
+        self.assertEqual(s["a"][0]["x"], b"abcd")
+
+    def test_base64_blobs_mismatch(self):
+        s = PersistentState(base64_blobs=True)
+        s["a"][0] = {"x": b"abcd"}
+        s.close()
+
+        with self.assertRaises(ValueError):
+            PersistentState()["a"][0] = {"x": b"efgh"}
+
+        migrate_base64_blobs()
+
+        with self.assertRaises(ValueError):
+            PersistentState(base64_blobs=True)["a"][0]
+        self.assertEqual(PersistentState()["a"][0]["x"], b"abcd")
+
+    def test_profile(self):
+        s = PersistentState(profile="fast")
+
+        s["a"][0] = {"x": 1}
+
+        self.assertEqual(s.connection().execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertEqual(s.connection().execute("PRAGMA synchronous").fetchone()[0], 1)
+        self.assertEqual(s["a"][0]["x"], 1)
+
+    def test_profile_readonly(self):
+        s = PersistentState()
+        s["a"][0] = {"x": 1}
+
+        ro = PersistentState(profile="readonly-mmap")
+        self.assertEqual(ro["a"][0]["x"], 1)
+
+        with self.assertRaises(sqlite3.OperationalError):
+            ro["a"][1] = {"x": 1}
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            PersistentState(profile="nope")
+
+    def test_cache(self):
+        s = PersistentState(cache_size=10)
+
+        s["a"][1] = {"x": 1}
+        self.assertEqual(s["a"][1]["x"], 1)
+        self.assertEqual(s["a"][1]["x"], 1)
+        self.assertIsNone(s["a"][2])
+        self.assertIsNone(s["a"][2])
+
+        self.assertEqual(s.cache.hits, 2)
+        self.assertEqual(s.cache.misses, 2)
+
+    def test_cache_invalidate(self):
+        s = PersistentState(cache_size=10)
+
+        self.assertIsNone(s["a"][1])
+        s["a"][1] = {"x": 1}
+        self.assertEqual(s["a"][1]["x"], 1)
+
+        s["a"].update({1: {"x": 2}})
+        self.assertEqual(s["a"][1]["x"], 2)
+
+        del s["a"][1]
+        self.assertIsNone(s["a"][1])
+
+        s["a"][1] = {"x": 3}
+        self.assertEqual(s["a"][1]["x"], 3)
+        del s["a"]
+        self.assertIsNone(s["a"][1])
+
+    def test_cache_write_during_read(self):
+        s = PersistentState(cache_size=10)
+        s["a"][1] = {"x": 1}
+        table = s["a"]
+
+        # Another thread commits a write after the row was read, but before it is cached
+        getitem_dict = table._getitem_dict
+
+        def racing_getitem_dict(key):
+            row = getitem_dict(key)
+            s["a"][1] = {"x": 2}
+            return row
+
+        table._getitem_dict = racing_getitem_dict
+        self.assertEqual(table[1]["x"], 1)
+        self.assertEqual(s["a"][1]["x"], 2)
+
+    def test_cache_pickle(self):
+        s = PersistentState(cache_size=10, cache_ttl=60)
+        s["a"][0] = {"x": 0}
+        self.assertEqual(s["a"][0]["x"], 0)
+
+        s2 = pickle.loads(pickle.dumps(s))
+        self.assertEqual(len(s2.cache), 0)
+        self.assertEqual((s2.cache.max_size, s2.cache.ttl), (10, 60))
+        self.assertEqual(s2["a"][0]["x"], 0)
+
+        p = get_context("spawn").Process(target=_child_setitem, args=(s, 1))
+        p.start()
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+        self.assertEqual(s["a"][1]["x"], 1)
+
+    def test_buffered(self):
+        s = PersistentState()
+
+        with s["a"].buffered(interval=60) as table:
+            table[1] = {"x": 1, "y": "a"}
+            table[1] = {"x": 2}
+            table[2] = {"x": 3}
+            del table[2]
+
+            self.assertDictEqual(table[1], {"id": 1, "x": 2, "y": "a"})
+            self.assertIsNone(table[2])
+            self.assertIsNone(s["a"][1])
+
+        self.assertDictEqual(s["a"][1], {"id": 1, "x": 2, "y": "a"})
+        self.assertIsNone(s["a"][2])
+
+    def test_buffered_overlay(self):
+        s = PersistentState()
+        s["a"][1] = {"x": 1, "y": "a"}
+
+        table = s["a"].buffered(interval=60)
+        table[1] = {"x": 2}
+        self.assertDictEqual(table[1], {"id": 1, "x": 2, "y": "a"})
+
+        del table[1]
+        table[1] = {"x": 3}
+        self.assertDictEqual(table[1], {"id": 1, "x": 3})
+
+        table.flush()
+        self.assertDictEqual(s["a"][1], {"id": 1, "x": 3, "y": None})
+
+    def test_buffered_overlay_types(self):
+        s = PersistentState()
+        s["a"][1] = {"x": 1, "y": "a", "z": 1.5}
+
+        table = s["a"].buffered(interval=60)
+        table[1] = {"x": "2", "y": 3, "z": 4, "b": True, "d": datetime(2020, 1, 1)}
+        table[2] = {"x": 5, "d": datetime(2020, 1, 1)}
+        pending = [table[1], table[2]]
+
+        table.flush()
+        self.assertEqual(pending[0], s["a"][1])
+        self.assertEqual([type(v) for v in pending[0].values()], [type(v) for v in s["a"][1].values()])
+        self.assertLessEqual(pending[1].items(), s["a"][2].items())
+        self.assertEqual(pending[1]["d"], "2020-01-01 00:00:00")
+
+    def test_buffered_max_items(self):
+        s = PersistentState()
+
+        table = s["a"].buffered(max_items=10, interval=60)
+        for i in range(25):
+            table[i] = {"x": i}
+
+        self.assertGreaterEqual(len(list(s["a"])), 10)
+        table.flush()
+        self.assertEqual(len(list(s["a"])), 25)
+
+    def test_write_behind(self):
+        with PersistentState(write_behind={"interval": 0.05}) as s:
+            s["a"][1] = {"x": 1}
+            self.assertEqual(s["a"][1]["x"], 1)
+            sleep(0.2)
+            self.assertEqual(s.connection().execute("SELECT x FROM a WHERE id=1").fetchone()[0], 1)
+
+            s["a"][2] = {"x": 2}
+
+        self.assertEqual(PersistentState()["a"][2]["x"], 2)
+
+    def test_iter_batches(self):
+        s = PersistentState()
+        s["a"].set_many((i, {"x": i % 3, "y": b'abc'}) for i in range(25))
+
+        rows = list(s["a"].iter(batch_size=10))
+        self.assertEqual([row["id"] for row in rows], list(range(25)))
+        self.assertDictEqual(rows[0], {"id": 0, "x": 0, "y": b'abc'})
+
+        rows = list(s["a"].iter(columns=["x"], batch_size=4, where="x=?", params=(1,)))
+        self.assertEqual([row["id"] for row in rows], list(range(1, 25, 3)))
+        self.assertDictEqual(rows[0], {"id": 1, "x": 1})
+
+    def test_iter_order_by(self):
+        s = PersistentState()
+        s["a"].set_many((i, {"x": i % 3 if i % 4 else None}) for i in range(25))
+
+        expected = sorted(s["a"], key=lambda r: (r["x"] is not None, r["x"] or 0, r["id"]))
+
+        rows = list(s["a"].iter(columns=["id"], batch_size=4, order_by="x"))
+        self.assertEqual([r["id"] for r in rows], [r["id"] for r in expected])
+
+        rows = list(s["a"].iter(columns=["id"], batch_size=4, order_by="x DESC"))
+        self.assertEqual([r["id"] for r in rows], [r["id"] for r in reversed(expected)])
+
+    def test_keys_len(self):
+        s = PersistentState()
+
+        self.assertEqual(len(s["a"]), 0)
+        self.assertEqual(list(s["a"].keys()), [])
+
+        s["a"].set_many((str(i), {"x": i}) for i in range(5))
+
+        self.assertEqual(len(s["a"]), 5)
+        self.assertEqual(sorted(s["a"].keys()), ["0", "1", "2", "3", "4"])
+
+    def test_create_index(self):
+        s = PersistentState()
+
+        s["a"][1] = {"x": 1}
+        s["a"].create_index("status")
+        self.assertFalse(s["a"].explain("WHERE x=?", 1)["uses_index"])
+
+        s["a"].update({2: {"x": 2, "status": "ok"}})
+        self.assertTrue(s["a"].explain("WHERE status=?", "ok")["uses_index"])
+        self.assertFalse(s["a"].explain("WHERE status=?", "ok")["full_scan"])
+        self.assertEqual(list(s["a"].sql("WHERE status=?", "ok"))[0]["id"], 2)
+
+        plan = s["a"].explain("WHERE x=? ORDER BY status", 1)
+        self.assertFalse(plan["uses_index"])
+        self.assertTrue(plan["full_scan"])
+
+    def test_create_index_drop_table(self):
+        s = PersistentState()
+
+        s["a"].create_index("x", "y", unique=True)
+        s["a"][1] = {"x": 1, "y": 1}
+        self.assertTrue(s["a"].explain("WHERE x=1 AND y=1")["uses_index"])
+
+        del s["a"]
+        s["a"].set_many([(1, {"x": 1, "y": 1})])
+        self.assertTrue(s["a"].explain("WHERE x=1 AND y=1")["uses_index"])
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            s["a"].set_many([(2, {"x": 1, "y": 1})])
+
+        s["a"].drop_index("x", "y")
+        self.assertFalse(s["a"].explain("WHERE x=1 AND y=1")["uses_index"])
+
+    def test_setitem_new_column(self):
+        s = PersistentState()
+
+        s["a"][1] = {"x": 1}
+        s["a"][2] = {"y": b'abc', "z": 2.5}
+        s["a"][1] = {"z": 1.5}
+
+        self.assertDictEqual(s["a"][1], {"id": 1, "x": 1, "y": None, "z": 1.5})
+        self.assertDictEqual(s["a"][2], {"id": 2, "x": None, "y": b'abc', "z": 2.5})
+
+    def test_export_import_ndjson(self):
+        s = PersistentState()
+        s["a"].set_many((i, {"x": i, "y": b'\x00abc', "z": None}) for i in range(100))
+
+        for compression, file in (("zstd", "state.ndjson.zst"), ("gz", "state.ndjson.gz"), ("", "state.ndjson")):
+            try:
+                self.assertEqual(s["a"].export_ndjson(file, compression=compression, threads=2), 100)
+                self.assertEqual(s["b"].import_ndjson(file, compression=compression, batch_size=30), 100)
+
+                self.assertEqual(len(s["b"]), 100)
+                self.assertDictEqual(s["b"][42], {"id": 42, "x": 42, "y": b'\x00abc', "z": None})
+                del s["b"]
+            finally:
+                if os.path.exists(file):
+                    os.remove(file)
+
+    def test_export_empty(self):
+        s = PersistentState()
+
+        try:
+            self.assertEqual(s["a"].export_ndjson("state.ndjson.zst"), 0)
+            self.assertEqual(s["b"].import_ndjson("state.ndjson.zst"), 0)
+        finally:
+            os.remove("state.ndjson.zst")
+
+    def test_to_columns(self):
+        s = PersistentState()
+        s["a"].set_many((i, {"x": i, "y": i / 2, "z": str(i), "w": None if i % 3 == 2 else i}) for i in range(25))
+
+        cols = s["a"].to_columns(["id", "x", "y", "z", "w"], batch_size=10)
+
+        self.assertEqual(cols["x"].dtype, np.int64)
+        self.assertEqual(cols["y"].dtype, np.float64)
+        self.assertEqual(cols["z"].dtype, object)
+        self.assertEqual(cols["w"].dtype, np.float64)
+        self.assertEqual(cols["x"].tolist(), list(range(25)))
+        self.assertEqual(cols["y"][3], 1.5)
+        self.assertEqual(cols["z"][3], "3")
+        self.assertTrue(np.isnan(cols["w"][2]))
+        self.assertEqual(cols["w"][3], 3)
+
+        cols = s["a"].to_columns(["x"], dtypes={"x": np.int32}, where="x >= ?", params=(20,))
+        self.assertEqual(cols["x"].dtype, np.int32)
+        self.assertEqual(cols["x"].tolist(), [20, 21, 22, 23, 24])
+
+    def test_to_columns_no_table(self):
+        s = PersistentState()
+
+        self.assertEqual(s["a"].to_columns(["x"])["x"].shape, (0,))
@@ -1,7 +1,8 @@
 import os
 from datetime import datetime
+from decimal import Decimal
 from enum import Enum
-from typing import Optional
+from typing import Optional, Set
 from unittest import TestCase
 
 from pydantic import BaseModel
@@ -26,6 +27,15 @@ class Polygon(BaseModel):
     status: Status = Status("yes")
 
 
+class Tagged(BaseModel):
+    tags: Set[str]
+    price: Decimal
+    created_date: datetime
+
+    class Config:
+        json_encoders = {Decimal: str}
+
+
 class TestPydanticTable(TestCase):
     def tearDown(self) -> None:
         if os.path.exists("state.db"):
@@ -108,3 +118,47 @@ class TestPydanticTable(TestCase):
         self.assertEqual(len(result), 2)
         self.assertEqual(result[0].created_date.year, 2000)
         self.assertEqual(result[1].created_date.year, 2010)
+
+    def test_compact_json(self):
+        s = PersistentState()
+
+        s["a"]["1"] = Point(x=1, y=2)
+
+        raw = s.connection().execute("SELECT json FROM a").fetchone()[0]
+        self.assertEqual(raw, '{"x":1,"y":2}')
+
+    def test_trusted(self):
+        s = PersistentState(trusted_pydantic=True)
+
+        s["a"]["1"] = Point(x=1, y=2)
+
+        self.assertEqual(s["a"]["1"], Point(x=1, y=2))
+
+    def test_set_many(self):
+        s = PersistentState()
+
+        s["a"].set_many((str(i), Point(x=i, y=i)) for i in range(10))
+
+        self.assertEqual(s["a"]["3"].x, 3)
+        self.assertEqual(len(list(s["a"])), 10)
+
+    def test_buffered(self):
+        s = PersistentState()
+
+        with s["a"].buffered() as table:
+            table["1"] = Point(x=1, y=2)
+            self.assertEqual(table["1"], Point(x=1, y=2))
+
+        self.assertEqual(s["a"]["1"], Point(x=1, y=2))
+
+    def test_pydantic_encoders(self):
+        s = PersistentState()
+
+        s["a"]["1"] = Tagged(tags={"a", "b"}, price=Decimal("1.5"), created_date=datetime(2020, 1, 2))
+
+        self.assertIn('"price":"1.5"', s["a"]._getitem_dict("1")["json"])
+
+        item = s["a"]["1"]
+        self.assertEqual(item.tags, {"a", "b"})
+        self.assertEqual(item.price, Decimal("1.5"))
+        self.assertEqual(item.created_date, datetime(2020, 1, 2))
@@ -0,0 +1,76 @@
+import os
+from glob import glob
+from unittest import TestCase
+
+from hexlib.db import ShardedPersistentState, PersistentState, reshard
+
+
+class TestShardedPersistentState(TestCase):
+
+    def tearDown(self) -> None:
+        for file in glob("state*.db*"):
+            os.remove(file)
+
+    def setUp(self) -> None:
+        for file in glob("state*.db*"):
+            os.remove(file)
+
+    def test_get_set(self):
+        s = ShardedPersistentState(shards=4)
+
+        for i in range(20):
+            s["a"][i] = {"x": i, "y": b'abc'}
+
+        self.assertDictEqual(s["a"][3], {"id": 3, "x": 3, "y": b'abc'})
+        self.assertEqual(len(glob("state.*.db")), 4)
+        self.assertTrue(all(len(shard["a"]) > 0 for shard in s.shards))
+
+        del s["a"][3]
+        self.assertIsNone(s["a"][3])
+        self.assertEqual(len(s["a"]), 19)
+
+    def test_fan_out(self):
+        for threads in (1, 4):
+            s = ShardedPersistentState(shards=4, threads=threads)
+            s["a"].set_many((i, {"x": i % 2}) for i in range(100))
+
+            self.assertEqual(sorted(row["id"] for row in s["a"]), list(range(100)))
+            self.assertEqual(sorted(s["a"].keys()), list(range(100)))
+            self.assertEqual(len(list(s["a"].sql("WHERE x=1"))), 50)
+            self.assertEqual(len(list(s["a"].iter(columns=["id"], batch_size=7))), 100)
+            self.assertEqual(len(s["a"]), 100)
+
+            # Stop early
+            self.assertEqual(len(list(zip(range(5), s["a"]))), 5)
+
+            del s["a"]
+            s.close()
+
+    def test_close_executor(self):
+        s = ShardedPersistentState(shards=4, threads=4)
+        s["a"].set_many((i, {"x": i}) for i in range(20))
+        self.assertEqual(len(list(s["a"])), 20)
+
+        executor = s._executor
+        s.close()
+        self.assertTrue(executor._shutdown)
+
+        # Used again after close()
+        self.assertEqual(len(list(s["a"])), 20)
+        self.assertIsNot(s._executor, executor)
+        s.close()
+
+    def test_reshard(self):
+        src = PersistentState()
+        src["a"].set_many((i, {"x": i, "y": b'abc'}) for i in range(50))
+        src["a"].create_index("x")
+        src["b"]["1"] = {"z": "z"}
+
+        dst = ShardedPersistentState(dbfile="state_sharded.db", shards=3)
+        reshard(src, dst)
+
+        self.assertEqual(dst.tables(), ["a", "b"])
+        self.assertEqual(len(dst["a"]), 50)
+        self.assertDictEqual(dst["a"][42], {"id": 42, "x": 42, "y": b'abc'})
+        self.assertDictEqual(dst["b"]["1"], {"id": "1", "z": "z"})
+        self.assertTrue(dst["a"].explain("WHERE x=1")["uses_index"])
@@ -1,4 +1,8 @@
+from time import sleep, time
 from unittest import TestCase
+from unittest.mock import patch
+
+from redis.exceptions import ResponseError
 
 from hexlib.db import VolatileState, VolatileBooleanState, VolatileQueue
 from hexlib.env import get_redis
@@ -42,6 +46,15 @@ class TestVolatileState(TestCase):
 
         self.assertEqual(sum(v for k, v in s["b"]), 10)
 
+    def test_iter_large(self):
+        s = VolatileState(prefix="test2")
+
+        s["b"].set_many((i, i) for i in range(2500))
+
+        self.assertEqual(len(s["b"]), 2500)
+        self.assertEqual(sum(v for k, v in s["b"].iter(count=100)), sum(range(2500)))
+        self.assertEqual(sorted(int(k) for k in s["b"].keys()), list(range(2500)))
+
     def test_int_key(self):
         s = VolatileState(prefix="test2")
         s["b"][1] = 1
@@ -55,6 +68,41 @@ class TestVolatileState(TestCase):
         del s["c"]["1"]
         self.assertIsNone(s["c"]["1"])
 
+    def test_many(self):
+        s = VolatileState(prefix="test2")
+
+        s["b"].set_many({i: {"x": i} for i in range(25)}, chunk_size=10)
+        s["b"].set_many([(25, 25)])
+
+        self.assertEqual(s["b"]["3"], {"x": 3})
+        self.assertEqual(s["b"].get_many([1, "2", 25, 100], chunk_size=3), [{"x": 1}, {"x": 2}, 25, None])
+
+        s["b"].delete_many(range(20), chunk_size=7)
+        self.assertEqual(s["b"].get_many([19, 20]), [None, {"x": 20}])
+
+    def test_serializers(self):
+        s = VolatileState(prefix="test1")
+        s["a"]["1"] = {"x": 1}
+
+        for serializer in ("orjson", "pickle+zstd"):
+            s2 = VolatileState(prefix="test1", serializer=serializer)
+            s2["a"]["2"] = {"x": 2}
+            large = {"y": b"x" * 2000} if serializer == "pickle+zstd" else {"y": "x" * 2000}
+            s2["a"]["3"] = large
+
+            # Mixed data is readable by both
+            self.assertEqual(s2["a"]["1"], {"x": 1})
+            self.assertEqual(s2["a"]["3"], large)
+            self.assertEqual(dict(s2["a"].iter())[b"3"], large)
+
+            if serializer == "orjson":
+                self.assertEqual(s["a"]["2"], {"x": 2})
+                self.assertEqual(s["a"]["3"], large)
+            else:
+                # Pickled values are only decoded by instances configured with pickle
+                with self.assertRaises(ValueError):
+                    _ = s["a"]["2"]
+
 
 class TestVolatileBoolState(TestCase):
 
@@ -100,6 +148,151 @@ class TestVolatileBoolState(TestCase):
         del s["c"]["1"]
         self.assertFalse(s["c"]["1"])
 
+    def test_many(self):
+        s = VolatileBooleanState(prefix="test2")
+
+        s["b"].set_many(range(25), chunk_size=10)
+
+        self.assertEqual(s["b"].get_many([1, "2", 100], chunk_size=2), [True, True, False])
+
+        s["b"].delete_many(range(20), chunk_size=7)
+        self.assertEqual(s["b"].get_many([19, 20]), [False, True])
+
+
+class TestVolatileBooleanStateBackends(TestCase):
+
+    def setUp(self) -> None:
+        rdb = get_redis()
+        rdb.delete("test4bitmap", "test4bloom:n", "test4bloom:0", "test4bloom:1", "test4bloom:2")
+
+    def test_bitmap(self):
+        s = VolatileBooleanState(prefix="test4", backend="bitmap")
+
+        s["bitmap"][3] = True
+        s["bitmap"]["10"] = True
+        self.assertTrue(s["bitmap"][3])
+        self.assertFalse(s["bitmap"][4])
+
+        s["bitmap"].set_many(range(100, 120, 2), chunk_size=3)
+        self.assertEqual(s["bitmap"].get_many([100, 101, 10], chunk_size=2), [True, False, True])
+        self.assertEqual(len(s["bitmap"]), 12)
+
+        del s["bitmap"][3]
+        s["bitmap"].delete_many([100, 102])
+        self.assertEqual(list(s["bitmap"]), [10] + list(range(104, 120, 2)))
+
+        with self.assertRaises(ValueError):
+            s["bitmap"][-1] = True
+
+        del s["bitmap"]
+        self.assertEqual(len(s["bitmap"]), 0)
+
+    def test_bloom(self):
+        s = VolatileBooleanState(prefix="test4", backend="bloom", bloom_capacity=1000, bloom_error_rate=0.01)
+
+        s["bloom"]["a"] = True
+        self.assertTrue(s["bloom"]["a"])
+        self.assertFalse(s["bloom"]["b"])
+
+        # Grows past its initial capacity
+        s["bloom"].set_many(range(3000), chunk_size=256)
+        s["bloom"].set_many(range(500))
+        # Keys that collide with earlier ones (false positives) are not counted
+        self.assertGreater(len(s["bloom"]), 2950)
+        self.assertLessEqual(len(s["bloom"]), 3001)
+        self.assertTrue(all(s["bloom"].get_many(range(3000))))
+
+        false_positives = sum(s["bloom"].get_many(range(3000, 8000)))
+        self.assertLess(false_positives, 5000 * 0.01)
+
+        with self.assertRaises(NotImplementedError):
+            del s["bloom"]["a"]
+
+        del s["bloom"]
+        self.assertFalse(s["bloom"]["a"])
+        self.assertEqual(get_redis().keys("test4bloom*"), [])
+
+    def test_bloom_segments(self):
+        s = VolatileBooleanState(prefix="test4", backend="bloom", bloom_capacity=1000, bloom_error_rate=0.01)
+
+        # Filters larger than a segment are split over several Redis strings
+        with patch("hexlib.db._BLOOM_SEGMENT_BITS", 4096):
+            s["bloom"].set_many(range(2000))
+            self.assertTrue(get_redis().exists("test4bloom:0:1"))
+            self.assertTrue(all(s["bloom"].get_many(range(2000))))
+            self.assertLess(sum(s["bloom"].get_many(range(2000, 4000))), 2000 * 0.01)
+
+            del s["bloom"]
+        self.assertEqual(get_redis().keys("test4bloom*"), [])
+
+
+class TestVolatileStateCache(TestCase):
+
+    def setUp(self) -> None:
+        rdb = get_redis()
+        rdb.delete("test3a", "test3b")
+        rdb.config_set("notify-keyspace-events", "Kghs")
+
+    def _wait_for(self, func, expected):
+        deadline = time() + 5
+        while func() != expected and time() < deadline:
+            sleep(0.01)
+        self.assertEqual(func(), expected)
+
+    def _test_invalidation(self, mode):
+        s = VolatileState(prefix="test3", cache_size=100, cache_invalidation=mode)
+        other = VolatileState(prefix="test3")
+
+        s["a"]["1"] = {"x": 1}
+        self.assertEqual(s["a"]["1"], {"x": 1})
+        self.assertEqual(s["a"]["1"], {"x": 1})
+        self.assertEqual(s.cache.hits, 1)
+
+        # Local writes are visible immediately
+        s["a"]["1"] = {"x": 2}
+        self.assertEqual(s["a"]["1"], {"x": 2})
+
+        other["a"]["1"] = {"x": 3}
+        self._wait_for(lambda: s["a"]["1"], {"x": 3})
+
+        del other["a"]
+        self._wait_for(lambda: s["a"]["1"], None)
+        s.close()
+
+    def test_tracking(self):
+        try:
+            get_redis().execute_command("CLIENT", "TRACKING", "OFF")
+        except ResponseError:
+            self.skipTest("CLIENT TRACKING is not supported by this server")
+        self._test_invalidation("tracking")
+
+    def test_keyspace(self):
+        self._test_invalidation("keyspace")
+
+    def test_boolean(self):
+        s = VolatileBooleanState(prefix="test3", cache_size=100, cache_invalidation="keyspace")
+        other = VolatileBooleanState(prefix="test3")
+
+        self.assertFalse(s["b"]["1"])
+        self.assertFalse(s["b"]["1"])
+        self.assertEqual(s.cache.stats()["hits"], 1)
+
+        other["b"]["1"] = True
+        self._wait_for(lambda: bool(s["b"]["1"]), True)
+
+        s["b"].delete_many(["1"])
+        self.assertFalse(s["b"]["1"])
+        s.close()
+
+    def test_max_size(self):
+        s = VolatileState(prefix="test3", cache_size=10, cache_invalidation="keyspace")
+        s["a"].set_many((i, i) for i in range(20))
+
+        for i in range(20):
+            self.assertEqual(s["a"][i], i)
+        self.assertEqual(s.cache.stats()["size"], 10)
+        s.close()
+
 
 class TestVolatileQueue(TestCase):
 
@@ -126,3 +319,32 @@ class TestVolatileQueue(TestCase):
         item = s.get()
 
         self.assertTrue(item == 123)
+
+    def test_many(self):
+        s = VolatileQueue(key="test5")
+        s.get_many(1000)
+
+        s.put_many(range(25), chunk_size=10)
+        items = s.get_many(10)
+        self.assertEqual(len(items), 10)
+
+        items += s.get_many(100)
+        self.assertEqual(sorted(items), list(range(25)))
+        self.assertEqual(s.get_many(10), [])
+
+    def test_iter(self):
+        s = VolatileQueue(key="test5")
+        s.get_many(1000)
+
+        s.put_many(range(25))
+        start = time()
+        self.assertEqual(sorted(s.iter(batch_size=7, idle_timeout=0.2)), list(range(25)))
+        self.assertLess(time() - start, 1)
+
+    def test_serializer(self):
+        s = VolatileQueue(key="test5", serializer="orjson")
+        s.get_many(1000)
+
+        s.put({"a": 1})
+        VolatileQueue(key="test5").put({"b": 2})
+        self.assertCountEqual(s.get_many(2), [{"a": 1}, {"b": 2}])
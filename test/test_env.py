@@ -0,0 +1,46 @@
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+import redis
+
+from hexlib import env
+from hexlib.env import get_redis_pool
+
+
+class TestRedisPool(TestCase):
+
+    def setUp(self) -> None:
+        env._redis_pools.clear()
+        env._redis_pools_pid = os.getpid()
+
+    def test_shared(self):
+        self.assertIs(get_redis_pool("localhost", 6379), get_redis_pool())
+        self.assertIsNot(get_redis_pool(db=1), get_redis_pool(db=0))
+        self.assertIsNot(get_redis_pool("otherhost"), get_redis_pool())
+
+    def test_env(self):
+        with patch.dict(os.environ, {
+            "REDIS_MAX_CONNECTIONS": "8",
+            "REDIS_KEEPALIVE": "1",
+            "REDIS_HEALTH_CHECK_INTERVAL": "30",
+        }):
+            pool = get_redis_pool()
+
+        self.assertIsInstance(pool, redis.BlockingConnectionPool)
+        self.assertEqual(pool.max_connections, 8)
+        self.assertTrue(pool.connection_kwargs["socket_keepalive"])
+        self.assertEqual(pool.connection_kwargs["health_check_interval"], 30)
+
+    def test_unix_socket(self):
+        with patch.dict(os.environ, {"REDIS_SOCKET": "/tmp/redis.sock"}):
+            pool = get_redis_pool()
+
+        self.assertIs(pool.connection_class, redis.UnixDomainSocketConnection)
+        self.assertEqual(pool.connection_kwargs["path"], "/tmp/redis.sock")
+
+    def test_fork(self):
+        pool = get_redis_pool()
+
+        with patch("os.getpid", return_value=os.getpid() + 1):
+            self.assertIsNot(get_redis_pool(), pool)
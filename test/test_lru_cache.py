@@ -0,0 +1,40 @@
+from time import sleep
+from unittest import TestCase
+
+from hexlib.misc import LRUCache
+
+
+class TestLRUCache(TestCase):
+
+    def test_evict(self):
+        cache = LRUCache(max_size=2)
+
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.1)
+
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        sleep(0.15)
+        self.assertIsNone(cache.get("a"))
+
+        self.assertDictEqual(cache.stats(), {"size": 0, "hits": 1, "misses": 1, "evictions": 0})
+
+    def test_clear_predicate(self):
+        cache = LRUCache()
+
+        cache.put(("a", 1), 1)
+        cache.put(("b", 1), 1)
+        cache.clear(lambda k: k[0] == "a")
+
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get(("b", 1)), 1)
@@ -1,5 +1,8 @@
+from time import time
 from unittest import TestCase
 
+import orjson
+
 from hexlib.env import get_redis
 from hexlib.mq import RedisMQ, parse_routing_key, RoutingKeyParts
 
@@ -8,7 +11,7 @@ class TestRedisMQ(TestCase):
 
     def setUp(self) -> None:
         self.rdb = get_redis()
-        self.rdb.delete("pending.test", "test_mq", "arc.test.msg.x")
+        self.rdb.delete("pending.test", "pending.test.deadlines", "dead.test", "test_mq", "arc.test.msg.x", "arc.test.other.x")
 
     def test_ack(self):
         mq = RedisMQ(self.rdb, consumer_name="test", max_pending_time=2, arc_lists=["arc"])
@@ -42,12 +45,134 @@ class TestRedisMQ(TestCase):
 
         self.assertEqual(msg1, msg1_)
 
+    def test_read_batches(self):
+        mq = RedisMQ(self.rdb, consumer_name="test", arc_lists=["arc"])
+
+        for i in range(1, 26):
+            mq.publish({"_id": i}, item_project="test", item_type="msg")
+        for i in range(26, 31):
+            mq.publish({"_id": i}, item_project="test", item_type="other")
+
+        batches = mq.read_batches(topics=["arc.test.*"], batch_size=10, max_wait=0.1)
+
+        ids = []
+        for _ in range(3):
+            messages, ack_all = next(batches)
+            self.assertEqual(len(messages), 10)
+            ids.extend(task["_id"] for _, task, _ in messages)
+        self.assertEqual(sorted(ids), list(range(1, 31)))
+        self.assertEqual(self.rdb.hlen("pending.test"), 30)
+
+        # Acknowledge one message individually, and the last batch at once
+        messages[0][2]()
+        self.assertEqual(self.rdb.hlen("pending.test"), 29)
+        ack_all()
+        self.assertEqual(self.rdb.hlen("pending.test"), 20)
+
+    def test_read_batches_invalid(self):
+        mq = RedisMQ(self.rdb, consumer_name="test", arc_lists=["arc"])
+
+        for i in range(1, 4):
+            mq.publish({"_id": i}, item_project="test", item_type="msg")
+        self.rdb.lpush("arc.test.msg.x", b'{"no_id":1}', b"not json")
+        for i in range(4, 7):
+            mq.publish({"_id": i}, item_project="test", item_type="msg")
+
+        messages, ack_all = next(mq.read_batches(topics=["arc.test.*"], batch_size=10, max_wait=0.1))
+
+        self.assertEqual(sorted(task["_id"] for _, task, _ in messages), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(self.rdb.hlen("pending.test"), 6)
+        self.assertCountEqual(self.rdb.lrange("dead.test", 0, -1), [b'{"no_id":1}', b"not json"])
+        ack_all()
+
+    def test_read_batches_wait(self):
+        mq = RedisMQ(self.rdb, consumer_name="test", arc_lists=["arc"])
+        mq.publish({"_id": 1}, item_project="test", item_type="msg")
+
+        batches = mq.read_batches(topics=["arc.test.*"], batch_size=10, max_wait=0.1)
+        messages, ack_all = next(batches)
+        self.assertEqual([task for _, task, _ in messages], [{"_id": 1}])
+        ack_all()
+
+        # Partial batches are yielded as soon as the lists are empty
+        mq.publish({"_id": 2}, item_project="test", item_type="msg")
+        messages, ack_all = next(batches)
+        self.assertEqual([task for _, task, _ in messages], [{"_id": 2}])
+        ack_all()
+
+        self.assertEqual(self.rdb.hlen("pending.test"), 0)
+
+    def test_pending_deadlines(self):
+        mq = RedisMQ(self.rdb, consumer_name="test", max_pending_time=0.5, arc_lists=["arc"], wait=0,
+                     pending_check_interval=0.1)
+
+        mq.publish({"_id": 1}, item_project="test", item_type="msg")
+        mq.publish({"_id": 2}, item_project="test", item_type="msg")
+
+        messages = mq.read_messages(topics=["arc.test.*"])
+        _, msg1, ack1 = next(messages)
+        _, msg2, ack2 = next(messages)
+        self.assertEqual(self.rdb.zcard("pending.test.deadlines"), 2)
+
+        # Still readable by older versions
+        pending = orjson.loads(self.rdb.hget("pending.test", msg2["_id"]))
+        self.assertEqual(pending["resubmit_at"], self.rdb.zscore("pending.test.deadlines", msg2["_id"]))
+
+        ack1()
+        self.assertEqual(self.rdb.zcard("pending.test.deadlines"), 1)
+        self.assertEqual(self.rdb.hlen("pending.test"), 1)
+
+        # Only the unacknowledged task is redelivered, and its deadline is pushed back
+        _, msg2_, ack2_ = next(messages)
+        self.assertEqual(msg2_, msg2)
+        self.assertGreater(self.rdb.zscore("pending.test.deadlines", msg2["_id"]), time())
+
+        ack2_()
+        self.assertEqual(self.rdb.zcard("pending.test.deadlines"), 0)
+        self.assertEqual(self.rdb.hlen("pending.test"), 0)
+
+    def test_pending_migration(self):
+        # Pending task written by an older version (no deadline)
+        self.rdb.hset("pending.test", "1", orjson.dumps({"resubmit_at": 0, "topic": "arc.test.msg.x", "task": {"_id": 1}}))
+
+        mq = RedisMQ(self.rdb, consumer_name="test", arc_lists=["arc"])
+        topic, msg, ack = next(mq.read_messages(topics=["arc.test.*"]))
+
+        self.assertEqual(msg, {"_id": 1})
+        ack()
+        self.assertEqual(self.rdb.hlen("pending.test"), 0)
+
     def test_no_id_field(self):
         mq = RedisMQ(self.rdb, consumer_name="test", max_pending_time=0.5, arc_lists=["arc"], wait=0)
 
         with self.assertRaises(ValueError):
             mq.publish({"a": 1}, item_project="test", item_type="msg")
 
+    def test_serializer(self):
+        mq = RedisMQ(self.rdb, consumer_name="test", arc_lists=["arc"], serializer="pickle")
+        legacy = RedisMQ(self.rdb, consumer_name="test", arc_lists=["arc"])
+
+        legacy.publish({"_id": 2}, item_project="test", item_type="msg")
+        mq.publish({"_id": 1, "data": b"\x00\x01"}, item_project="test", item_type="msg")
+
+        messages = mq.read_messages(topics=["arc.*"])
+        _, msg1, ack1 = next(messages)
+        _, msg2, ack2 = next(messages)
+
+        self.assertEqual(msg1, {"_id": 1, "data": b"\x00\x01"})
+        self.assertEqual(msg2, {"_id": 2})
+        ack1()
+        ack2()
+
+    def test_serializer_pickle_not_allowed(self):
+        mq = RedisMQ(self.rdb, consumer_name="test", arc_lists=["arc"], serializer="pickle")
+        legacy = RedisMQ(self.rdb, consumer_name="test", arc_lists=["arc"])
+
+        mq.publish({"_id": 1}, item_project="test", item_type="msg")
+
+        with self.assertRaises(ValueError):
+            next(legacy.read_messages(topics=["arc.*"]))
+
 
 class TestRoutingKey(TestCase):
 
@@ -0,0 +1,47 @@
+from unittest import TestCase
+
+import orjson
+import umsgpack
+
+from hexlib.serializers import SERIALIZERS, get_serializer, loads, TAG, allowed_ids
+
+
+class TestSerializers(TestCase):
+
+    def test_roundtrip(self):
+        val = {"a": 1, "b": [1.5, "x", None], "c": "é" * 2000}
+
+        for name, serializer in SERIALIZERS.items():
+            data = serializer.dumps(val)
+            self.assertTrue(data.startswith(TAG), name)
+            self.assertEqual(loads(data, allowed=allowed_ids(serializer)), val, name)
+
+    def test_compression(self):
+        small = {"a": "x"}
+        large = {"a": "x" * 10000}
+
+        self.assertEqual(
+            get_serializer("orjson+zstd").dumps(small)[2:],
+            get_serializer("orjson").dumps(small)[2:]
+        )
+        self.assertLess(len(get_serializer("orjson+zstd").dumps(large)), 1000)
+        self.assertEqual(loads(get_serializer("orjson+zstd").dumps(large)), large)
+
+    def test_untagged(self):
+        self.assertEqual(loads(umsgpack.dumps({"a": 1})), {"a": 1})
+        self.assertEqual(loads(orjson.dumps({"a": 1}), fallback=orjson.loads), {"a": 1})
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            get_serializer("xml")
+        with self.assertRaises(ValueError):
+            loads(TAG + b"\x7fabc")
+
+    def test_pickle_not_allowed(self):
+        data = get_serializer("pickle").dumps({"a": 1})
+
+        with self.assertRaises(ValueError):
+            loads(data)
+        with self.assertRaises(ValueError):
+            loads(data, allowed=allowed_ids(get_serializer("orjson")))
+        self.assertEqual(loads(data, allowed=allowed_ids(get_serializer("pickle+zstd"))), {"a": 1})